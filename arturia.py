@@ -2,13 +2,14 @@ import arrangement
 import arturia_leds
 import arturia_midi
 import channels
+import config
 import general
 import midi
 import patterns
-import time
 import transport
 import ui
 
+from arturia_animation import LedAnimator
 from arturia_display import ArturiaDisplay
 from arturia_encoders import ArturiaInputControls
 from arturia_leds import ArturiaLights
@@ -23,14 +24,40 @@ if SCRIPT_VERSION >= 8:
   import plugins
 
 
+# Dirty flags for FL Studio state that page line providers read: channel selection, names, volume, panning and pitch,
+# patterns and playlist/mixer tracks.
+_PAGE_DIRTY_FLAGS = (1          # HW_Dirty_Mixer_Sel
+                     | 2        # HW_Dirty_Mixer_Display
+                     | 4        # HW_Dirty_Mixer_Controls
+                     | 32       # HW_Dirty_FocusedWindow   (channel selection)
+                     | 1024     # HW_Dirty_Patterns
+                     | 2048     # HW_Dirty_Tracks
+                     | 4096     # HW_Dirty_ControlValues
+                     | 16384    # HW_Dirty_Names
+                     | 32768    # HW_Dirty_ChannelRackGroup
+                     | 65536    # HW_ChannelEvent
+                     )
+
+# Dirty flags for FL Studio state the metronome lights depend on: channel selection, channel colors and the metronome
+# toggle.
+_METRONOME_DIRTY_FLAGS = (32        # HW_Dirty_FocusedWindow   (channel selection)
+                          | 256     # HW_Dirty_LEDs
+                          | 8192    # HW_Dirty_Colors
+                          | 32768   # HW_Dirty_ChannelRackGroup
+                          | 65536   # HW_ChannelEvent
+                          )
+
+
 class ArturiaController:
     """Controller responsible for managing all the different components in a single class. """
-    def __init__(self):
-        self._scheduler = Scheduler()
+    def __init__(self, clock=None):
+        self._scheduler = Scheduler(idle_budget_us=config.SCHEDULER_IDLE_BUDGET_US, clock=clock)
+        self._clock = self._scheduler.clock()
         self._display = ArturiaDisplay(self._scheduler)
         self._paged_display = ArturiaPagedDisplay(self._display, self._scheduler)
-        self._lights = ArturiaLights()
-        self._metronome = VisualMetronome(self._lights)
+        self._lights = ArturiaLights(self._scheduler)
+        self._animator = LedAnimator(self._lights, self._scheduler)
+        self._metronome = VisualMetronome(self._lights, self._animator)
         self._encoders = ArturiaInputControls(self._paged_display, self._lights)
         self._last_send = 0
         self._send_interscript_idle = True
@@ -41,6 +68,9 @@ class ArturiaController:
     def lights(self):
         return self._lights
 
+    def animator(self):
+        return self._animator
+
     def metronome(self):
         return self._metronome
 
@@ -55,6 +85,11 @@ class ArturiaController:
 
     def Sync(self, flags):
         """ Syncs up all visual indicators on keyboard with changes from FL Studio. """
+        if flags & _PAGE_DIRTY_FLAGS:
+            self._paged_display.Invalidate()
+        if flags & _METRONOME_DIRTY_FLAGS:
+            self._metronome.Invalidate()
+
         # Update buttons
         if flags & midi.HW_Dirty_LEDs:
             led_map = {
@@ -97,12 +132,14 @@ class ArturiaController:
 
     def _TurnOffOctaveLights(self):
         # Disable blinking lights on octave keyboard
-        if time.time() - self._last_send >= 0.5:
+        if self._clock.time_ms() - self._last_send >= 500:
+            # The keyboard blinks these lights on its own, so they must be sent even if they were already set off.
+            self._lights.Invalidate([ArturiaLights.ID_OCTAVE_PLUS, ArturiaLights.ID_OCTAVE_MINUS])
             self._lights.SetLights({
                 ArturiaLights.ID_OCTAVE_PLUS: ArturiaLights.LED_OFF,
                 ArturiaLights.ID_OCTAVE_MINUS: ArturiaLights.LED_OFF,
             })
-            self._last_send = time.time()
+            self._last_send = self._clock.time_ms()
 
     def RefreshDisplay(self):
         self._paged_display.Refresh()
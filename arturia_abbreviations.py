@@ -0,0 +1,121 @@
+import config
+
+# Built-in abbreviations, matched case-insensitively against whole words. Entries in config.DISPLAY_ABBREVIATIONS are
+# added to, and take precedence over, these.
+DEFAULT_ABBREVIATIONS = {
+    'Volume': 'Vol',
+    'Envelope': 'Env',
+    'Filter': 'Flt',
+    'Attack': 'Atk',
+    'Decay': 'Dcy',
+    'Sustain': 'Sus',
+    'Release': 'Rel',
+    'Resonance': 'Res',
+    'Parameter': 'Param',
+    'Master': 'Mstr',
+    'Size': 'Sz',
+    'Frequency': 'Freq',
+    'Cutoff': 'Cut',
+    'Amount': 'Amt',
+    'Oscillator': 'Osc',
+    'Modulation': 'Mod',
+    'Velocity': 'Vel',
+    'Feedback': 'Fdbk',
+    'Delay': 'Dly',
+    'Reverb': 'Rvb',
+    'Level': 'Lvl',
+    'Panning': 'Pan',
+    'Detune': 'Dtn',
+    'Channel': 'Ch',
+    'Control': 'Ctrl',
+    'Pattern': 'Ptn',
+}
+
+# Punctuation that may trail a word without preventing it from being abbreviated.
+_TRAILING_PUNCTUATION = ':,.;-'
+_VOWELS = 'aeiouAEIOU'
+# Words are never shortened below this many characters, except by the final truncation.
+_MIN_WORD_LENGTH = 3
+
+
+class Abbreviator:
+    """ Shortens text to fit a number of display columns.
+
+    Text that fits is returned as is. Otherwise it is shortened progressively, stopping as soon as it fits:
+        1. Runs of spaces are collapsed.
+        2. Words found in the abbreviation table are abbreviated, following the case of the word.
+        3. Vowels after the first letter are dropped, longest word first, unless that leaves fewer than three
+           characters.
+        4. The longest words are cut, down to three characters.
+        5. The text is truncated.
+    Results are kept in a least-recently-used cache keyed by the input text, so repeated names cost a dict lookup.
+    """
+    def __init__(self, abbreviations=None, width=16, cache_size=256):
+        """ Create an abbreviator.
+
+        :param abbreviations: mapping of word -> abbreviation, matched case-insensitively. Defaults to
+            DEFAULT_ABBREVIATIONS updated with config.DISPLAY_ABBREVIATIONS.
+        :param width: number of columns the text should fit in.
+        :param cache_size: maximum number of results to cache.
+        """
+        if abbreviations is None:
+            abbreviations = dict(DEFAULT_ABBREVIATIONS)
+            abbreviations.update(config.DISPLAY_ABBREVIATIONS)
+        # Table compiled to lower-case word -> abbreviation.
+        self._table = {word.lower(): abbreviation for word, abbreviation in abbreviations.items()}
+        self._width = width
+        self._cache_size = cache_size
+        # Insertion ordered mapping of input text -> result. The least recently used entry is first.
+        self._cache = {}
+
+    def Fit(self, text):
+        """ Returns text shortened to fit the width of the abbreviator. """
+        cache = self._cache
+        result = cache.pop(text, None)
+        if result is None:
+            result = self._fit(text)
+            if len(cache) >= self._cache_size:
+                del cache[next(iter(cache))]
+        cache[text] = result
+        return result
+
+    def _abbreviate_word(self, word):
+        core = word.rstrip(_TRAILING_PUNCTUATION)
+        abbreviation = self._table.get(core.lower())
+        if abbreviation is None:
+            return word
+        if core.isupper():
+            abbreviation = abbreviation.upper()
+        elif core.islower():
+            abbreviation = abbreviation.lower()
+        return abbreviation + word[len(core):]
+
+    def _fit(self, text):
+        width = self._width
+        if len(text) <= width:
+            return text
+        words = [w for w in text.split(' ') if w]
+        if _joined_length(words) > width:
+            words = [self._abbreviate_word(w) for w in words]
+        # Longest words are shortened first.
+        order = sorted(range(len(words)), key=lambda i: -len(words[i]))
+        for i in order:
+            if _joined_length(words) <= width:
+                break
+            word = words[i]
+            if len(word) > _MIN_WORD_LENGTH and word.isalpha():
+                stripped = word[0] + ''.join(c for c in word[1:] if c not in _VOWELS)
+                if len(stripped) >= _MIN_WORD_LENGTH:
+                    words[i] = stripped
+        for i in order:
+            excess = _joined_length(words) - width
+            if excess <= 0:
+                break
+            word = words[i]
+            if len(word) > _MIN_WORD_LENGTH:
+                words[i] = word[:max(_MIN_WORD_LENGTH, len(word) - excess)]
+        return ' '.join(words)[:width]
+
+
+def _joined_length(words):
+    return sum(len(w) for w in words) + len(words) - 1
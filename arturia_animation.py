@@ -0,0 +1,123 @@
+from arturia_scheduler import PRIORITY_NORMAL
+
+
+class LedAnimation:
+    """ Precomputed sequence of frames for a fixed set of LEDs.
+
+    Each frame is a flat sequence holding one value per LED, in the order of led_ids. Frames are converted once to the
+    mappings ArturiaLights.SetLights takes, and the LEDs that change between two frames are computed the first time the
+    animation makes that transition and reused afterwards.
+    """
+    def __init__(self, led_ids, frames, rgb_led_ids=()):
+        """ Create an animation.
+
+        :param led_ids: ids of the LEDs the animation sets.
+        :param frames: sequence of frames, each a sequence of LED values in the order of led_ids.
+        :param rgb_led_ids: ids of the LEDs whose values are RGB colors. Other LEDs are monochrome.
+        """
+        self._led_ids = tuple(led_ids)
+        self._rgb = tuple(led_id in rgb_led_ids for led_id in self._led_ids)
+        self._frames = [tuple(frame) for frame in frames]
+        # (monochrome, rgb) mappings of LED id -> value for each frame.
+        self._frame_maps = [self._to_maps(range(len(self._led_ids)), frame) for frame in self._frames]
+        # Mapping of (from frame index, to frame index) -> (monochrome, rgb) mappings of the LEDs that differ.
+        self._diffs = {}
+
+    def _to_maps(self, indices, frame):
+        mono = {}
+        rgb = {}
+        for i in indices:
+            (rgb if self._rgb[i] else mono)[self._led_ids[i]] = frame[i]
+        return mono, rgb
+
+    def NumFrames(self):
+        return len(self._frames)
+
+    def Frame(self, index):
+        """ Returns the (monochrome, rgb) mappings of LED id -> value of a frame. """
+        return self._frame_maps[index]
+
+    def Diff(self, from_index, to_index):
+        """ Returns the (monochrome, rgb) mappings of LED id -> value of the LEDs that change between two frames. """
+        key = (from_index, to_index)
+        diff = self._diffs.get(key)
+        if diff is None:
+            from_frame = self._frames[from_index]
+            to_frame = self._frames[to_index]
+            diff = self._to_maps([i for i in range(len(to_frame)) if to_frame[i] != from_frame[i]], to_frame)
+            self._diffs[key] = diff
+        return diff
+
+
+class _Playback:
+    """ State of an animation that is playing. """
+    __slots__ = ('animation', 'frame', 'num_writes', 'task')
+
+    def __init__(self, animation):
+        self.animation = animation
+        # Index of the frame shown last, or None if no frame was shown yet.
+        self.frame = None
+        # ArturiaLights.NumWrites() right after the frame was shown.
+        self.num_writes = None
+        # Repeating task advancing the frames, if the animation is clocked by the scheduler.
+        self.task = None
+
+
+class LedAnimator:
+    """ Plays LedAnimations on ArturiaLights, setting only the LEDs that change from one frame to the next.
+
+    An animation is either clocked by the scheduler, looping over its frames at a fixed period, or stepped by the caller
+    (for example from the beat indicator) with ShowFrame. If anything else set lights since the previous frame of an
+    animation, its next frame is set in full so that LEDs overwritten in between are restored.
+    """
+    def __init__(self, lights, scheduler):
+        self._lights = lights
+        self._scheduler = scheduler
+        # Mapping of animation name -> _Playback.
+        self._playing = {}
+
+    def Play(self, name, animation, period_ms=None, priority=PRIORITY_NORMAL):
+        """ Start playing an animation, replacing the animation playing under the same name.
+
+        :param name: name of the animation. Also used as the label of the scheduler task.
+        :param animation: the LedAnimation to play.
+        :param period_ms: if set, the first frame is shown now and the animation loops, advancing one frame every
+            period_ms milliseconds. Otherwise nothing is shown until ShowFrame is called.
+        :param priority: scheduler lane of the task advancing the frames.
+        """
+        self.Stop(name)
+        playback = _Playback(animation)
+        self._playing[name] = playback
+        if period_ms is not None:
+            self._show(playback, 0)
+            playback.task = self._scheduler.ScheduleRepeating(lambda: self._advance(playback), period_ms, label=name,
+                                                              priority=priority)
+
+    def ShowFrame(self, name, index):
+        """ Show a frame of a playing animation. """
+        self._show(self._playing[name], index)
+
+    def Stop(self, name):
+        """ Stop an animation, leaving its LEDs as they are. """
+        playback = self._playing.pop(name, None)
+        if playback is not None:
+            self._scheduler.CancelTask(playback.task)
+
+    def IsPlaying(self, name):
+        return name in self._playing
+
+    def _advance(self, playback):
+        self._show(playback, (playback.frame + 1) % playback.animation.NumFrames())
+
+    def _show(self, playback, index):
+        lights = self._lights
+        if playback.frame is not None and playback.num_writes == lights.NumWrites():
+            mono, rgb = playback.animation.Diff(playback.frame, index)
+        else:
+            mono, rgb = playback.animation.Frame(index)
+        if mono:
+            lights.SetLights(mono)
+        if rgb:
+            lights.SetLights(rgb, rgb=True)
+        playback.frame = index
+        playback.num_writes = lights.NumWrites()
@@ -0,0 +1,284 @@
+""" Microbenchmarks of the hot paths of the scripts, run against the FL Studio API stand-ins.
+
+This runs outside of FL Studio, from the script folder:
+
+    python arturia_benchmarks.py              # run all benchmarks
+    python arturia_benchmarks.py dispatch     # run only the named benchmarks
+
+Each benchmark prints its measurements, along with those of the approach it replaced where that is still available,
+so that a change to a hot path can be checked against the numbers quoted in its commit.
+"""
+import argparse
+import sys
+import time
+
+from arturia_standins import FLState, StandInEvent, StandInModule, make_fl_modules
+
+# Messages the device module stand-in was asked to send and dispatch. Installed before the script modules are loaded,
+# as they import the FL Studio modules.
+_state = FLState()
+_sysex = []
+_dispatched = []
+sys.modules.update(make_fl_modules(_state, {}))
+sys.modules['device'] = StandInModule('device', {
+    'getName': lambda: 'Arturia KeyLab mkII 61',
+    'midiOutSysex': _sysex.append,
+    'dispatch': lambda receiver, message: _dispatched.append(message),
+    'dispatchReceiverCount': lambda: 1,
+}, {})
+
+from arturia_clock import VirtualClock
+
+# Mapping of benchmark name -> (function, description), in the order they run.
+_BENCHMARKS = {}
+
+
+def _benchmark(name, description):
+    def register(fn):
+        _BENCHMARKS[name] = (fn, description)
+        return fn
+    return register
+
+
+def _rate(fn, items, repeat):
+    # Returns the number of calls of fn per second, calling it with items in turn.
+    num_items = len(items)
+    start = time.perf_counter()
+    for i in range(repeat):
+        fn(items[i % num_items])
+    return repeat / (time.perf_counter() - start)
+
+
+@_benchmark('dispatch', 'events per second through ArturiaMidiProcessor.ProcessEvent')
+def bench_dispatch(repeat=200000):
+    from arturia import ArturiaController
+    from arturia_midi import CompiledMidiEventDispatcher, MidiEventDispatcher
+    from arturia_processor import ArturiaMidiProcessor
+
+    processor = ArturiaMidiProcessor(ArturiaController(clock=VirtualClock()))
+    # Transport, solo release, knob, slider, pad bank and encoder events.
+    events = [StandInEvent(144, 91, 127), StandInEvent(144, 8, 0), StandInEvent(176, 60, 1),
+              StandInEvent(224, 0, 100), StandInEvent(144, 24, 127), StandInEvent(176, 20, 65)]
+    print('  ProcessEvent with the processor handlers: %.2f M events/s' % (
+        _rate(processor.ProcessEvent, events, repeat) / 1e6))
+
+    # The routing alone, with every handler replaced by a no-op: the flat table against the nested
+    # MidiEventDispatchers (midiId, then controlNum) that the processor used before.
+    def noop(event):
+        pass
+
+    compiled = processor._dispatcher
+    nested = MidiEventDispatcher(lambda event: event.midiId)
+    for midi_id in range(0x80, 0x100, 0x10):
+        row = CompiledMidiEventDispatcher._index(midi_id, 0)
+        if compiled._press_table[row] is None:
+            continue
+        by_control = MidiEventDispatcher(lambda event: event.controlNum)
+        for control_num in range(128):
+            index = row + control_num
+            if compiled._press_table[index] is CompiledMidiEventDispatcher._drop_unknown:
+                continue
+            ignore_release = compiled._release_table[index] is CompiledMidiEventDispatcher._drop_release
+            compiled._press_table[index] = noop
+            compiled._release_table[index] = CompiledMidiEventDispatcher._drop_release if ignore_release else noop
+            by_control.SetHandler(control_num, noop,
+                                  filter_fn=(lambda event: event.controlVal != 0) if ignore_release else None)
+        nested.SetHandler(midi_id, by_control.Dispatch)
+    print('  routing only, nested MidiEventDispatchers: %.2f M events/s' % (
+        _rate(nested.Dispatch, events, repeat) / 1e6))
+    print('  routing only, CompiledMidiEventDispatcher: %.2f M events/s' % (
+        _rate(compiled.Dispatch, events, repeat) / 1e6))
+
+
+@_benchmark('queues', 'HeapTaskQueue against TimerWheelTaskQueue with many pending tasks')
+def bench_queues(pending_counts=(10000, 100000), num_ops=200000, max_delay_ms=16000):
+    import random
+    from arturia_scheduler import HeapTaskQueue, ScheduledTask, TimerWheelTaskQueue
+
+    def noop():
+        pass
+
+    # Steady state: Idle ticks every millisecond, and every due task is popped and pushed again with a new delay, so
+    # the number of pending tasks stays constant. An op is one pop and one push.
+    for num_pending in pending_counts:
+        results = []
+        for queue_class in (HeapTaskQueue, TimerWheelTaskQueue):
+            rng = random.Random(0)
+            queue = queue_class(time_ms=0)
+            for _ in range(num_pending):
+                queue.Push(ScheduledTask(rng.randrange(1, max_delay_ms), noop))
+            time_ms = 0
+            ops = 0
+            start = time.perf_counter()
+            while ops < num_ops:
+                time_ms += 1
+                entry = queue.PopDue(time_ms)
+                while entry is not None:
+                    entry.time_ms = time_ms + rng.randrange(1, max_delay_ms)
+                    queue.Push(entry)
+                    ops += 1
+                    entry = queue.PopDue(time_ms)
+            results.append('%s %.2f us/op' % (queue_class.__name__, (time.perf_counter() - start) * 1e6 / ops))
+        print('  %6d pending: %s' % (num_pending, ', '.join(results)))
+
+
+def _display_frame_before(line1, line2, offset1, offset2):
+    # How a frame was rendered on every refresh before the marquee frames were precomputed: the 16 visible characters
+    # of each line sliced and encoded, then concatenated into the frame.
+    line1_bytes = bytearray(line1[offset1:offset1 + 16], 'utf-8')
+    line2_bytes = bytearray(line2[offset2:offset2 + 16], 'utf-8')
+    data = bytes([0x04, 0x00, 0x60])
+    data += bytes([0x01]) + line1_bytes + bytes([0x00])
+    data += bytes([0x02]) + line2_bytes + bytes([0x00])
+    data += bytes([0x7F])
+    return data
+
+
+@_benchmark('display', 'time and temporary memory to render one frame of two scrolling display lines')
+def bench_display(repeat=20000):
+    import tracemalloc
+    from arturia_display import ArturiaDisplay, _LINE1_SLICE, _LINE2_SLICE
+    from arturia_scheduler import Scheduler
+
+    line1 = 'A channel name much too long for the display'
+    line2 = 'And a pattern name that scrolls as well'
+    display = ArturiaDisplay(Scheduler(clock=VirtualClock()))
+    display.SetLines(line1=line1, line2=line2)
+    frame = display._last_payload
+    num_offsets = max(len(display._line1_frames), len(display._line2_frames))
+    offsets = [(i % len(display._line1_frames), i % len(display._line2_frames)) for i in range(num_offsets)]
+
+    def render_before(offset):
+        _display_frame_before(line1, line2, offset[0], offset[1])
+
+    def render_after(offset):
+        display._line1_display_offset, display._line2_display_offset = offset
+        frame[_LINE1_SLICE] = display._get_line1_bytes()
+        frame[_LINE2_SLICE] = display._get_line2_bytes()
+
+    for label, render in (('sliced and concatenated per frame', render_before),
+                          ('precomputed segments', render_after)):
+        # Largest amount of memory held by temporaries while rendering a frame. CPython does not count allocations,
+        # so the peak traced by tracemalloc stands for how much each frame allocates.
+        tracemalloc.start()
+        peak_bytes = 0
+        for offset in offsets:
+            tracemalloc.reset_peak()
+            current_bytes = tracemalloc.get_traced_memory()[0]
+            render(offset)
+            peak_bytes = max(peak_bytes, tracemalloc.get_traced_memory()[1] - current_bytes)
+        tracemalloc.stop()
+        frames_per_second = _rate(render, offsets, repeat)
+        print('  %-34s %5.2f us/frame, %4d bytes of temporaries' % (label, 1e6 / frames_per_second, peak_bytes))
+
+
+def _load_midi_script():
+    # Loads the MIDI script with its scheduler and lights on a virtual clock. Returns (module, clock).
+    import device_arturia_keylab_mkii_midi as midi_script
+    clock = VirtualClock(start_ms=0)
+    midi_script._scheduler._clock = clock
+    midi_script._lights._clock = clock
+    return midi_script, clock
+
+
+def _drain(midi_script, clock, duration_ms=250, idle_interval_ms=5):
+    # Calls OnIdle as FL Studio would until the pending light updates have been dispatched.
+    for _ in range(int(duration_ms / idle_interval_ms)):
+        clock.Advance(idle_interval_ms)
+        midi_script.OnIdle()
+
+
+@_benchmark('pad-hit', 'MIDI script time to handle a pad press and release, with and without the LED color cache')
+def bench_pad_hit(repeat=20000, num_channels=8):
+    from arturia_leds import ArturiaLights
+    midi_script, clock = _load_midi_script()
+    _drain(midi_script, clock)
+
+    # Presses and releases of the 16 pads, on each of a few selected channels with their own colors.
+    hits = [(channel, 36 + pad) for channel in range(num_channels) for pad in range(16)]
+
+    def pad_hit(hit):
+        _state.selected_channel = hit[0]
+        midi_script.OnMidiMsg(StandInEvent(169, hit[1], 100))
+        midi_script.OnMidiMsg(StandInEvent(137, hit[1], 0))
+
+    def uncached_channel_colors(rgb):
+        # What fadedColor and fullColor computed on every call before the colors were cached.
+        rgb &= 0xFFFFFF
+        return (ArturiaLights.mapToClosestHue(rgb, sat=1.0, value=0.02, maxrgb=127),
+                ArturiaLights.mapToClosestHue(rgb, sat=1.0, value=0.2, maxrgb=127))
+
+    cached_channel_colors = ArturiaLights.__dict__['channelColors']
+    colors = [_state.channel_colors[channel] for channel in range(num_channels)]
+    try:
+        for label, channel_colors in (('HSV conversion on every hit', staticmethod(uncached_channel_colors)),
+                                      ('cached by channel color', cached_channel_colors)):
+            ArturiaLights.channelColors = channel_colors
+            ArturiaLights._channel_color_cache.clear()
+            lookups_per_second = _rate(ArturiaLights.channelColors, colors, repeat)
+            hits_per_second = _rate(pad_hit, hits, repeat)
+            _drain(midi_script, clock)
+            print('  %-28s %5.2f us/color lookup, %5.2f us/pad press and release' % (
+                label, 1e6 / lookups_per_second, 1e6 / hits_per_second))
+    finally:
+        ArturiaLights.channelColors = cached_channel_colors
+
+
+def _legacy_dispatch_count(payload):
+    # Number of messages the MIDI script dispatched for a payload before payloads were packed: a begin message, one
+    # message per two payload bytes and an end message.
+    return 2 + (len(payload) + 1) // 2
+
+
+@_benchmark('dispatch-per-pad', 'messages the MIDI script dispatches to the DAW script for pad light updates')
+def bench_dispatch_per_pad(num_hits=64):
+    from arturia_midi import InterScriptPayloadDecoder
+
+    midi_script, clock = _load_midi_script()
+    _drain(midi_script, clock)
+
+    def count_dispatches():
+        # Returns (packed, legacy) message counts of what was dispatched since the last call. The payloads are
+        # recovered from the packed messages to count what the legacy framing would have taken for them.
+        decoder = InterScriptPayloadDecoder()
+        num_legacy = 0
+        for message in _dispatched:
+            payloads = decoder.Feed(message & 0xFF, (message >> 8) & 0xFF, (message >> 16) & 0xFF)
+            if payloads is not None:
+                num_legacy += sum(_legacy_dispatch_count(payload) for payload in payloads)
+        num_packed = len(_dispatched)
+        del _dispatched[:]
+        return num_packed, num_legacy
+
+    count_dispatches()
+    for i in range(num_hits):
+        midi_script.OnMidiMsg(StandInEvent(169, 36 + i % 16, 100))
+        _drain(midi_script, clock)
+        midi_script.OnMidiMsg(StandInEvent(137, 36 + i % 16, 0))
+        _drain(midi_script, clock)
+    num_packed, num_legacy = count_dispatches()
+    print('  pad press and release: %.1f messages packed, %.1f with the begin/end framing' % (
+        num_packed / num_hits, num_legacy / num_hits))
+
+    midi_script._lights.SetPadLights([[0x010203 + row * 4 + col for col in range(4)] for row in range(4)], rgb=True)
+    _drain(midi_script, clock)
+    num_packed, num_legacy = count_dispatches()
+    print('  repaint of the 16 RGB pads: %d messages packed, %d with the begin/end framing' % (num_packed, num_legacy))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run microbenchmarks of the Arturia Keylab scripts.')
+    parser.add_argument('names', nargs='*', metavar='name', help='benchmarks to run: %s. Defaults to all.' % (
+        ', '.join(_BENCHMARKS)))
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in _BENCHMARKS:
+            parser.error('unknown benchmark %s' % name)
+    for name in args.names or _BENCHMARKS:
+        fn, description = _BENCHMARKS[name]
+        print('%s: %s' % (name, description))
+        fn()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import debug
+
+from arturia_clock import SYSTEM_CLOCK
+
+# Callback trace file format
+# --------------------------
+# A trace starts with TRACE_MAGIC, a version byte and the timestamp in microseconds of the first record (varint), then
+# holds one record per callback:
+#   kind (1 byte) | microseconds since the previous record (varint) | arguments
+# where the arguments are:
+#   KIND_MIDI_MSG:   status, data1, data2 (1 byte each)
+#   KIND_IDLE:       none
+#   KIND_REFRESH:    flags (varint)
+#   KIND_BEAT:       value (1 byte)
+# Varints are unsigned little-endian base-128: 7 bits per byte, with the high bit set on all bytes but the last.
+TRACE_MAGIC = b'AKTR'
+TRACE_VERSION = 1
+
+KIND_MIDI_MSG = 1
+KIND_IDLE = 2
+KIND_REFRESH = 3
+KIND_BEAT = 4
+
+# Name of each callback kind, as used in the device scripts.
+KIND_NAMES = {
+    KIND_MIDI_MSG: 'OnMidiMsg',
+    KIND_IDLE: 'OnIdle',
+    KIND_REFRESH: 'OnRefresh',
+    KIND_BEAT: 'OnUpdateBeatIndicator',
+}
+
+
+def _append_varint(buffer, value):
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+class CallbackCapture:
+    """ Records the callbacks FL Studio makes into a script to a compact binary trace file for offline replay.
+
+    Records are buffered in memory and appended to the file once the buffer grows past flush_bytes, and on Close.
+    """
+    def __init__(self, path, clock=None, flush_bytes=16384):
+        """ Create a capture, truncating the trace file.
+
+        :param path: path of the trace file to write.
+        :param clock: clock to timestamp the callbacks with. Defaults to the system clock.
+        :param flush_bytes: number of buffered bytes past which they are written to the file.
+        """
+        self._path = path
+        self._clock = clock if clock is not None else SYSTEM_CLOCK
+        self._flush_bytes = flush_bytes
+        self._buffer = bytearray(TRACE_MAGIC)
+        self._buffer.append(TRACE_VERSION)
+        # Timestamp in microseconds of the last record.
+        self._last_us = None
+        with open(path, 'wb'):
+            pass
+
+    def _begin_record(self, kind):
+        time_us = int(self._clock.time_ms() * 1000)
+        if self._last_us is None:
+            # The scripts share the clock, so the start timestamps line up the traces of both scripts.
+            _append_varint(self._buffer, time_us)
+            self._last_us = time_us
+        self._buffer.append(kind)
+        _append_varint(self._buffer, max(0, time_us - self._last_us))
+        self._last_us = time_us
+
+    def _end_record(self):
+        if len(self._buffer) >= self._flush_bytes:
+            self.Flush()
+
+    def OnMidiMsg(self, event):
+        self._begin_record(KIND_MIDI_MSG)
+        self._buffer.append(event.status & 0xFF)
+        self._buffer.append(event.data1 & 0xFF)
+        self._buffer.append(event.data2 & 0xFF)
+        self._end_record()
+
+    def OnIdle(self):
+        self._begin_record(KIND_IDLE)
+        self._end_record()
+
+    def OnRefresh(self, flags):
+        self._begin_record(KIND_REFRESH)
+        _append_varint(self._buffer, flags)
+        self._end_record()
+
+    def OnUpdateBeatIndicator(self, value):
+        self._begin_record(KIND_BEAT)
+        self._buffer.append(value & 0xFF)
+        self._end_record()
+
+    def Flush(self):
+        """ Append the buffered records to the trace file. """
+        with open(self._path, 'ab') as f:
+            f.write(self._buffer)
+        self._buffer = bytearray()
+
+    def Close(self):
+        self.Flush()
+
+
+def open_capture(script_name):
+    """ Returns a CallbackCapture writing to <debug.CAPTURE_PATH_PREFIX>_<script_name>.trace, or None if capturing
+    is disabled.
+    """
+    if not debug.CAPTURE_PATH_PREFIX:
+        return None
+    return CallbackCapture('%s_%s.trace' % (debug.CAPTURE_PATH_PREFIX, script_name))
+
+
+def read_trace(data):
+    """ Decode a trace.
+
+    :param data: the contents of a trace file.
+    :return: list of (timestamp in microseconds, kind, arguments tuple).
+    """
+    if data[:len(TRACE_MAGIC)] != TRACE_MAGIC:
+        raise ValueError('Not a callback trace')
+    if data[len(TRACE_MAGIC)] != TRACE_VERSION:
+        raise ValueError('Unsupported trace version %d' % data[len(TRACE_MAGIC)])
+    records = []
+    pos = len(TRACE_MAGIC) + 1
+    if pos == len(data):
+        return records
+    time_us, pos = _read_varint(data, pos)
+    while pos < len(data):
+        kind = data[pos]
+        delta_us, pos = _read_varint(data, pos + 1)
+        time_us += delta_us
+        if kind == KIND_MIDI_MSG:
+            args = (data[pos], data[pos + 1], data[pos + 2])
+            pos += 3
+        elif kind == KIND_IDLE:
+            args = ()
+        elif kind == KIND_REFRESH:
+            flags, pos = _read_varint(data, pos)
+            args = (flags,)
+        elif kind == KIND_BEAT:
+            args = (data[pos],)
+            pos += 1
+        else:
+            raise ValueError('Unknown record kind %d at offset %d' % (kind, pos - 1))
+        records.append((time_us, kind, args))
+    return records
@@ -0,0 +1,70 @@
+import time
+
+
+class SystemClock:
+    """ Clock backed by the system's monotonic timer. This is the clock used when running inside FL Studio. """
+    @staticmethod
+    def time_ms():
+        """ Returns the current timestamp in milliseconds. """
+        return time.monotonic() * 1000
+
+    @staticmethod
+    def sleep(seconds):
+        """ Block the calling thread for the given number of seconds. """
+        time.sleep(seconds)
+
+
+# Shared clock instance used by components that are not given a clock explicitly.
+SYSTEM_CLOCK = SystemClock()
+
+
+class VirtualClock:
+    """ Clock that only moves when told to, so that sessions can be simulated faster than real-time.
+
+    Components constructed with a VirtualClock never read the system time. Sleeping advances the clock instead of
+    blocking, and RunFor drives schedulers from one due task to the next so that minutes of simulated time replay in
+    milliseconds with every task running exactly on its scheduled timestamp.
+    """
+    def __init__(self, start_ms=0):
+        self._now_ms = start_ms
+
+    def time_ms(self):
+        """ Returns the current simulated timestamp in milliseconds. """
+        return self._now_ms
+
+    def sleep(self, seconds):
+        """ Advance the simulated time by the given number of seconds without blocking. """
+        self._now_ms += seconds * 1000
+
+    def Advance(self, delta_ms):
+        """ Move the simulated time forward by delta_ms milliseconds. """
+        self._now_ms += delta_ms
+        return self
+
+    def AdvanceTo(self, time_ms):
+        """ Move the simulated time forward to time_ms. Time never moves backwards. """
+        self._now_ms = max(self._now_ms, time_ms)
+        return self
+
+    def RunFor(self, duration_ms, schedulers, idle_interval_ms=0):
+        """ Simulate the OnIdle loop of FL Studio for duration_ms milliseconds.
+
+        :param duration_ms: number of milliseconds of simulated time to run for.
+        :param schedulers: list of Scheduler instances, all constructed with this clock, to call Idle on.
+        :param idle_interval_ms: if positive, Idle is called at this fixed interval like FL Studio would. Otherwise,
+            the clock jumps straight to the next due task so that tasks run exactly on time.
+        """
+        end_ms = self._now_ms + duration_ms
+        while self._now_ms < end_ms:
+            if idle_interval_ms > 0:
+                next_ms = self._now_ms + idle_interval_ms
+            else:
+                next_ms = end_ms
+                for scheduler in schedulers:
+                    due_ms = scheduler.NextTaskTimeMs()
+                    if due_ms is not None and due_ms < next_ms:
+                        next_ms = due_ms
+            self.AdvanceTo(min(next_ms, end_ms))
+            for scheduler in schedulers:
+                scheduler.Idle()
+        return self
@@ -1,6 +1,15 @@
-import time
+import config
 
-from arturia_midi import send_to_device
+try:
+    import unicodedata
+except ImportError:
+    # FL Studio's embedded Python may not ship unicodedata. Characters missing from _LCD_CHAR_TABLE then render as '?'.
+    unicodedata = None
+
+from arturia_abbreviations import Abbreviator
+from arturia_midi import SysexCounters, send_to_device, sysex_size
+from arturia_scheduler import PRIORITY_BEST_EFFORT
+from arturia_throttle import Throttle
 
 # Minimum interval required between display updates. NOTE: If this is too low, it's possible to overload the display
 # and cause the keyboard to get into a bad state where display changes are rejected until keyboard is powered off.
@@ -8,11 +17,74 @@ from arturia_midi import send_to_device
 # second. If we go by 28 fps for human perception, this translates to roughly 35 ms between intervals.
 INTERVAL_MS_BETWEEN_REQUESTS = 35
 
+# Identical frames are re-sent after this many milliseconds in case something else, like the keyboard firmware after a
+# mode change, has overwritten the display in the meantime.
+MAX_MS_BETWEEN_IDENTICAL_FRAMES = 2000
+
+# Number of characters that fit on a line of the display.
+LCD_COLUMNS = 16
+
+# Bytes framing the two line segments of a display update.
+_FRAME_HEADER = bytes([0x04, 0x00, 0x60])
+_FRAME_FOOTER = bytes([0x7F])
+# Prefixes identifying the line a segment is written to.
+_LINE1_PREFIX = bytes([0x01])
+_LINE2_PREFIX = bytes([0x02])
+_SEGMENT_END = bytes([0x00])
+# Every line segment is exactly this long, so every frame has the same size.
+_SEGMENT_SIZE = len(_LINE1_PREFIX) + LCD_COLUMNS + len(_SEGMENT_END)
+_LINE1_SLICE = slice(len(_FRAME_HEADER), len(_FRAME_HEADER) + _SEGMENT_SIZE)
+_LINE2_SLICE = slice(_LINE1_SLICE.stop, _LINE1_SLICE.stop + _SEGMENT_SIZE)
+
+# Replacements for characters outside the display's character set (printable ASCII) that do not decompose into one.
+_LCD_CHAR_TABLE = {
+    'ß': 'ss', 'æ': 'ae', 'Æ': 'AE', 'œ': 'oe', 'Œ': 'OE', 'ø': 'o', 'Ø': 'O', 'ł': 'l', 'Ł': 'L', 'đ': 'd', 'Đ': 'D',
+    'ð': 'd', 'Ð': 'D', 'þ': 'th', 'Þ': 'TH', 'ı': 'i', '‘': "'", '’': "'", '“': '"', '”': '"', '–': '-', '—': '-',
+    '…': '...', '•': '*', '·': '.', '×': 'x', '÷': '/', '°': 'o', '♯': '#', '♭': 'b',
+}
+# Accented letters mapped to their base letter, for when unicodedata is unavailable.
+for _base, _accented in (('A', 'ÀÁÂÃÄÅĀĂĄ'), ('a', 'àáâãäåāăą'), ('C', 'ÇĆČ'), ('c', 'çćč'), ('D', 'Ď'), ('d', 'ď'),
+                         ('E', 'ÈÉÊËĒĘĚ'), ('e', 'èéêëēęě'), ('G', 'Ğ'), ('g', 'ğ'), ('I', 'ÌÍÎÏĪİ'), ('i', 'ìíîïī'),
+                         ('N', 'ÑŃŇ'), ('n', 'ñńň'), ('O', 'ÒÓÔÕÖŌŐ'), ('o', 'òóôõöōő'), ('R', 'Ř'), ('r', 'ř'),
+                         ('S', 'ŚŠŞ'), ('s', 'śšş'), ('T', 'Ť'), ('t', 'ť'), ('U', 'ÙÚÛÜŪŮŰ'), ('u', 'ùúûüūůű'),
+                         ('Y', 'ÝŸ'), ('y', 'ýÿ'), ('Z', 'ŹŻŽ'), ('z', 'źżž')):
+    for _char in _accented:
+        _LCD_CHAR_TABLE[_char] = _base
+del _base, _accented, _char
+
+# Memoized mapping of character -> display text for every character seen so far that is not printable ASCII.
+_LCD_CHAR_CACHE = {}
+
+
+def _transliterate_char(char):
+    text = char if ' ' <= char <= '~' else _LCD_CHAR_TABLE.get(char)
+    if text is None and unicodedata is not None:
+        # Compatibility decomposition splits accents from letters and maps full-width and styled forms to ASCII.
+        decomposed = ''.join(c for c in unicodedata.normalize('NFKD', char) if not unicodedata.combining(c))
+        if decomposed and all(' ' <= c <= '~' for c in decomposed):
+            text = decomposed
+    if text is None:
+        text = ' ' if char.isspace() else '?'
+    _LCD_CHAR_CACHE[char] = text
+    return text
+
+
+def to_lcd_text(text):
+    """ Returns text with every character mapped into the display's single-byte character set (printable ASCII). """
+    if text.isascii() and text.isprintable():
+        return text
+    cache = _LCD_CHAR_CACHE
+    return ''.join([cache[c] if c in cache else _transliterate_char(c) for c in text])
+
 
 class ArturiaDisplay:
     """ Manages scrolling display of two lines so that long strings can be scrolled on each line. """
     def __init__(self, scheduler):
         self._scheduler = scheduler
+        self._clock = scheduler.clock()
+        # How many characters to allow last char to scroll before starting over.
+        self._end_padding = 8
+
         # Holds the text to display on first line. May exceed the 16-char display limit.
         self._line1 = ' '
         # Holds the text to display on second line. May exceed the 16-char display limit.
@@ -24,6 +96,12 @@ class ArturiaDisplay:
         self._ephemeral_line2 = ' '
         self._expiration_time_ms = 0
 
+        # Ready to send line segments for every scroll offset of the lines above, rebuilt only when a line changes.
+        self._line1_frames = self._build_frames(_LINE1_PREFIX, self._line1)
+        self._line2_frames = self._build_frames(_LINE2_PREFIX, self._line2)
+        self._ephemeral_line1_frames = self._line1_frames
+        self._ephemeral_line2_frames = self._line2_frames
+
         # Holds the starting offset of where the line1 text should start.
         self._line1_display_offset = 0
         # Holds the starting offset of where the line2 text should start.
@@ -32,97 +110,128 @@ class ArturiaDisplay:
         self._last_update_ms = 0
         # Last timestamp in milliseconds when bytes were sent.
         self._last_send_ms = 0
+        # Limits frames to one per send interval. The latest frame of a burst is sent once the interval has passed.
+        self._throttle = Throttle(scheduler, INTERVAL_MS_BETWEEN_REQUESTS, self._emit_frame, label='display refresh',
+                                  priority=PRIORITY_BEST_EFFORT)
 
         # Minimum interval before text is scrolled
         self._scroll_interval_ms = 500
-        # How many characters to allow last char to scroll before starting over.
-        self._end_padding = 8
-        # Track what's currently being displayed
-        self._last_payload = bytes()
-        # Last idle scheduled task
-        self._last_scheduled_task = None
+        # Preallocated frame buffer. Holds the last frame sent, which is what's currently being displayed.
+        self._last_payload = bytearray(_FRAME_HEADER + bytes(2 * _SEGMENT_SIZE) + _FRAME_FOOTER)
+        self._last_line1 = None
+        self._last_line2 = None
+        # Counts the bytes sent to the display and the bytes saved by not re-sending unchanged lines.
+        self._counters = SysexCounters('display')
+
+    @staticmethod
+    def _render_segment(prefix, lcd_text, start_pos):
+        # Render exactly LCD_COLUMNS bytes of lcd_text, padded with blanks, into a line segment.
+        line = lcd_text[start_pos:start_pos + LCD_COLUMNS].ljust(LCD_COLUMNS)
+        return prefix + line.encode('ascii') + _SEGMENT_END
+
+    def _build_frames(self, prefix, line_src):
+        # Build the line segment sent for each scroll offset of line_src. A line scrolls one character at a time until
+        # its last character is _end_padding characters past the end of the display, then wraps back to the start.
+        lcd_text = to_lcd_text(line_src)
+        num_offsets = 1
+        if len(lcd_text) > LCD_COLUMNS:
+            num_offsets = len(lcd_text) + self._end_padding - LCD_COLUMNS + 1
+        return [self._render_segment(prefix, lcd_text, start_pos) for start_pos in range(num_offsets)]
+
+    @staticmethod
+    def _get_segment(frames, prefix, line_src, start_pos):
+        # Get the segment to display for line_src starting at start_pos.
+        if start_pos < len(frames):
+            return frames[start_pos]
+        # Ephemeral lines share the scroll offset of the regular lines and may be shorter than the offset reached.
+        return ArturiaDisplay._render_segment(prefix, to_lcd_text(line_src), start_pos)
 
     def _get_line1_bytes(self):
-        # Get up to 16-bytes the exact chars to display for line 1.
-        start_pos = self._line1_display_offset
-        end_pos = start_pos + 16
-        line_src = self._line1
+        # Get the segment with the 16 chars to display for line 1.
         if self._expiration_time_ms > self.time_ms():
-            line_src = self._ephemeral_line1
-        return bytearray(line_src[start_pos:end_pos], 'utf-8')
+            return self._get_segment(self._ephemeral_line1_frames, _LINE1_PREFIX, self._ephemeral_line1,
+                                     self._line1_display_offset)
+        return self._get_segment(self._line1_frames, _LINE1_PREFIX, self._line1, self._line1_display_offset)
 
     def _get_line2_bytes(self):
-        # Get up to 16-bytes the exact chars to display for line 2.
-        start_pos = self._line2_display_offset
-        end_pos = start_pos + 16
-        line_src = self._line2
+        # Get the segment with the 16 chars to display for line 2.
         if self._expiration_time_ms > self.time_ms():
-            line_src = self._ephemeral_line2
-        return bytearray(line_src[start_pos:end_pos], 'utf-8')
+            return self._get_segment(self._ephemeral_line2_frames, _LINE2_PREFIX, self._ephemeral_line2,
+                                     self._line2_display_offset)
+        return self._get_segment(self._line2_frames, _LINE2_PREFIX, self._line2, self._line2_display_offset)
 
-    def _get_new_offset(self, start_pos, line_src):
-        end_pos = start_pos + 16
-        if end_pos >= len(line_src) + self._end_padding or len(line_src) <= 16:
-            return 0
-        else:
+    @staticmethod
+    def _get_new_offset(start_pos, frames):
+        if start_pos + 1 < len(frames):
             return start_pos + 1
+        return 0
 
     def _update_scroll_pos(self):
         current_time_ms = self.time_ms()
         if current_time_ms >= self._scroll_interval_ms + self._last_update_ms:
-            self._line1_display_offset = self._get_new_offset(self._line1_display_offset, self._line1)
-            self._line2_display_offset = self._get_new_offset(self._line2_display_offset, self._line2)
+            self._line1_display_offset = self._get_new_offset(self._line1_display_offset, self._line1_frames)
+            self._line2_display_offset = self._get_new_offset(self._line2_display_offset, self._line2_frames)
             self._last_update_ms = current_time_ms
 
-    @staticmethod
-    def time_ms():
+    def time_ms(self):
         # Get the current timestamp in milliseconds
-        return time.monotonic() * 1000
-
-    _ABBREVIATION_MAP = {
-        'VOLUME': 'VOL',
-        'ENVELOPE': 'ENV',
-        'FILTER': 'FLT',
-        'ATTACK': 'ATK',
-        'RESONANCE': 'RES',
-        'PARAMETER': 'PARAM',
-        'MASTER': 'MSTR',
-        'SIZE': 'SZ',
-    }
+        return self._clock.time_ms()
+
+    _abbreviator = None
+
     @staticmethod
     def abbreviate(line):
-        if len(line) <= 16:
-            return line
-        words = line.split(' ')
-        shortened_words = []
-        for w in words:
-            if not w:
-                continue
-            if w in ArturiaDisplay._ABBREVIATION_MAP:
-                w = ArturiaDisplay._ABBREVIATION_MAP[w]
-            shortened_words.append(w)
-        return ' '.join(shortened_words)
-
-    def _refresh_display(self, schedule=True):
-        # Internally called to refresh the display now.
-        data = bytes([0x04, 0x00, 0x60])
-        data += bytes([0x01]) + self._get_line1_bytes() + bytes([0x00])
-        data += bytes([0x02]) + self._get_line2_bytes() + bytes([0x00])
-        data += bytes([0x7F])
+        """ Returns line shortened to fit the 16 character display. See arturia_abbreviations.Abbreviator. """
+        if ArturiaDisplay._abbreviator is None:
+            ArturiaDisplay._abbreviator = Abbreviator(width=LCD_COLUMNS)
+        return ArturiaDisplay._abbreviator.Fit(line)
+
+    def counters(self):
+        """ Returns the SysexCounters for the traffic sent to the display. """
+        return self._counters
+
+    def _refresh_display(self):
+        # Internally called to refresh the display now, or as soon as the send interval allows.
+        line1 = self._get_line1_bytes()
+        line2 = self._get_line2_bytes()
         self._update_scroll_pos()
-        current_time_ms = self.time_ms()
+        self._throttle.Submit((line1, line2))
+
+    def _emit_frame(self, unused_key, lines):
+        return self._send_lines(lines[0], lines[1], self.time_ms())
 
-        if schedule:
-            if self._last_scheduled_task:
-                self._scheduler.CancelTask(self._last_scheduled_task)
-            self._last_scheduled_task = self._scheduler.ScheduleTask(
-                lambda: self._refresh_display(schedule=False),
-                delay=INTERVAL_MS_BETWEEN_REQUESTS)
+    def _send_lines(self, line1, line2, current_time_ms):
+        # Send the frame made of the two line segments. Returns False if the frame was skipped because the device
+        # already shows it.
+        if (line1 == self._last_line1 and line2 == self._last_line2
+                and current_time_ms - self._last_send_ms < MAX_MS_BETWEEN_IDENTICAL_FRAMES):
+            # Device already shows this frame.
+            self._counters.RecordSkipped(sysex_size(self._last_payload))
+            return False
 
-        if current_time_ms - self._last_send_ms > INTERVAL_MS_BETWEEN_REQUESTS:
-            send_to_device(data)
-            self._last_send_ms = current_time_ms
-            self._last_payload = data
+        payload = frame = self._last_payload
+        if config.DISPLAY_SEND_CHANGED_LINE_ONLY and self._last_line1 is not None:
+            if line1 == self._last_line1:
+                payload = b''.join((_FRAME_HEADER, line2, _FRAME_FOOTER))
+            elif line2 == self._last_line2:
+                payload = b''.join((_FRAME_HEADER, line1, _FRAME_FOOTER))
+        frame[_LINE1_SLICE] = line1
+        frame[_LINE2_SLICE] = line2
+        # Only whole frames may replace a frame still waiting for output. A single line relies on the frame before it.
+        send_to_device(payload, priority=PRIORITY_BEST_EFFORT, key=self if payload is frame else None)
+        payload_size = sysex_size(payload)
+        self._counters.RecordSent(payload_size, sysex_size(frame) - payload_size)
+        self._last_send_ms = current_time_ms
+        self._last_line1 = line1
+        self._last_line2 = line2
+        return True
+
+    def Invalidate(self):
+        """ Forget what the device shows so that the next refresh sends the whole frame, for example after the keyboard
+        drew over the display in another mode.
+        """
+        self._last_line1 = None
+        self._last_line2 = None
 
     def ResetScroll(self):
         self._line1_display_offset = 0
@@ -137,16 +246,20 @@ class ArturiaDisplay:
             interval is provided, lines are interpreted as a blank line if not provided.
         """
         if expires is None:
-            if line1 is not None:
+            if line1 is not None and line1 != self._line1:
                 self._line1 = line1
-            if line2 is not None:
+                self._line1_frames = self._build_frames(_LINE1_PREFIX, line1)
+            if line2 is not None and line2 != self._line2:
                 self._line2 = line2
+                self._line2_frames = self._build_frames(_LINE2_PREFIX, line2)
         else:
             self._expiration_time_ms = self.time_ms() + expires
-            if line1 is not None:
+            if line1 is not None and line1 != self._ephemeral_line1:
                 self._ephemeral_line1 = line1
-            if line2 is not None:
+                self._ephemeral_line1_frames = self._build_frames(_LINE1_PREFIX, line1)
+            if line2 is not None and line2 != self._ephemeral_line2:
                 self._ephemeral_line2 = line2
+                self._ephemeral_line2_frames = self._build_frames(_LINE2_PREFIX, line2)
 
         self._refresh_display()
         return self
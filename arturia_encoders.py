@@ -311,7 +311,7 @@ class ArturiaInputControls:
         hint_title = ArturiaDisplay.abbreviate(hint_title)
 
         self._paged_display.SetPageLines('hint', line1=hint_title, line2=hint_value)
-        current_time_ms = ArturiaDisplay.time_ms()
+        current_time_ms = self._paged_display.display().time_ms()
 
         if fl_hint:
             ui.setHintMsg('%s %s' % (hint_title, hint_value))
@@ -1,14 +1,22 @@
-from arturia_midi import send_to_device
+from arturia_midi import SysexCounters, send_to_device, sysex_size
 
 import config
 import device
-import time
 import utils
 
 ESSENTIAL_KEYBOARD = 'mkII' not in device.getName()
 MKII_88_KEYBOARD = 'mkII 88' in device.getName()
 MKII_49_KEYBOARD = 'mkII 49' in device.getName()
 
+# Number of LED ids the framebuffers hold.
+_NUM_LED_IDS = 128
+# Framebuffer value for an LED whose state is not known. LED values and color components are 7-bit.
+_UNKNOWN = 0xFF
+
+# LED values already shown are sent again after this many milliseconds in case something else, like the keyboard
+# firmware after a mode change, has changed the LED in the meantime.
+MAX_MS_BETWEEN_IDENTICAL_LED_VALUES = 2000
+
 
 class ArturiaLights:
     """Maintains setting all the button lights on the Arturia device."""
@@ -132,13 +140,56 @@ class ArturiaLights:
             [44, 47, 50, 53],
         ]
 
-    def __init__(self, send_fn=None):
+    # Maximum number of channel colors whose LED colors are cached.
+    CHANNEL_COLOR_CACHE_SIZE = 256
+    # Insertion ordered mapping of 24-bit channel color -> (faded, full) LED colors. The least recently used entry is
+    # first.
+    _channel_color_cache = {}
+
+    # Number of bytes on the wire of each kind of message.
+    _MONOCHROME_MESSAGE_SIZE = sysex_size(SET_MONOCHROME_LIGHT_COMMAND) + 2
+    _RGB_MESSAGE_SIZE = sysex_size(SET_RGB_LIGHT_COMMAND) + 4
+
+    def __init__(self, scheduler, send_fn=None, messages_per_second=None, burst=None, flush_fn=None):
+        """ Create the lights controller.
+
+        :param scheduler: Scheduler that runs the task sending queued LED values. It is run from OnIdle.
+        :param send_fn: function called to send a command payload. Defaults to sending SysEx to the device.
+        :param messages_per_second: maximum average rate of LED messages. Defaults to config.LED_MESSAGES_PER_SECOND.
+        :param burst: maximum number of LED messages sent back to back. Defaults to config.LED_MESSAGE_BURST.
+        :param flush_fn: optional function called after a run of commands was passed to send_fn, so that send_fn may
+        batch them.
+        """
         if send_fn is None:
             send_fn = send_to_device
+        if messages_per_second is None:
+            messages_per_second = config.LED_MESSAGES_PER_SECOND
+        if burst is None:
+            burst = config.LED_MESSAGE_BURST
         self._send_fn = send_fn
-
-        # Map of last send times
-        self._last_send_ms = {}
+        self._flush_fn = flush_fn
+        self._scheduler = scheduler
+        self._clock = scheduler.clock()
+        self._ms_per_message = 1000.0 / messages_per_second
+        # How far the virtual send time may run ahead of the clock, in milliseconds.
+        self._max_ahead_ms = (burst - 1) * self._ms_per_message
+        # Mapping of LED id -> (value, rgb) waiting to be sent, in the order the LEDs were first queued. A new value for
+        # a queued LED replaces the queued one.
+        self._queue = {}
+        # Timestamp in milliseconds at which the messages sent so far would have finished had they been sent at exactly
+        # the configured rate. A message may be sent while this is at most a burst ahead of the clock.
+        self._virtual_send_ms = 0
+        # Shadow framebuffers of what the keyboard shows, indexed by LED id. Monochrome values take one byte per LED and
+        # RGB colors three (red, green, blue). Only LEDs whose value differs from the framebuffer are sent.
+        self._mono_framebuffer = bytearray([_UNKNOWN]) * _NUM_LED_IDS
+        self._rgb_framebuffer = bytearray([_UNKNOWN]) * (3 * _NUM_LED_IDS)
+        # Timestamp in milliseconds at which each LED was last sent. The framebuffers are only trusted for
+        # MAX_MS_BETWEEN_IDENTICAL_LED_VALUES after that.
+        self._sent_ms = [0] * _NUM_LED_IDS
+        # Counts the messages sent and the messages suppressed because the LED already had the value.
+        self._counters = SysexCounters('leds')
+        # Number of times lights were set, so that animations can tell whether LEDs may have changed behind them.
+        self._num_writes = 0
 
     @staticmethod
     def AsOnOffByte(is_on):
@@ -187,13 +238,32 @@ class ArturiaLights:
         r, g, b = utils.HSVtoRGB(h, s, v)
         return ArturiaLights.rgb2int(int(maxrgb*r), int(maxrgb*g), int(maxrgb*b))
 
+    @staticmethod
+    def channelColors(rgb):
+        """ Returns the (faded, full) 7-bit LED colors for a channel color.
+
+        Results are cached by 24-bit color, so the HSV conversion runs once per channel color rather than on every pad
+        hit or refresh.
+        """
+        # Only the RGB bits take part in the conversion. FL Studio colors may have the alpha bits set.
+        rgb &= 0xFFFFFF
+        cache = ArturiaLights._channel_color_cache
+        colors = cache.pop(rgb, None)
+        if colors is None:
+            colors = (ArturiaLights.mapToClosestHue(rgb, sat=1.0, value=0.02, maxrgb=127),
+                      ArturiaLights.mapToClosestHue(rgb, sat=1.0, value=0.2, maxrgb=127))
+            if len(cache) >= ArturiaLights.CHANNEL_COLOR_CACHE_SIZE:
+                del cache[next(iter(cache))]
+        cache[rgb] = colors
+        return colors
+
     @staticmethod
     def fadedColor(rgb):
-        return ArturiaLights.mapToClosestHue(rgb, sat=1.0, value=0.02, maxrgb=127)
+        return ArturiaLights.channelColors(rgb)[0]
 
     @staticmethod
     def fullColor(rgb):
-        return ArturiaLights.mapToClosestHue(rgb, sat=1.0, value=0.2, maxrgb=127)
+        return ArturiaLights.channelColors(rgb)[1]
 
     @staticmethod
     def getPadLedId(button_id):
@@ -236,24 +306,131 @@ class ArturiaLights:
         led_map = {k: v for k, v in zip(ArturiaLights.ARRAY_IDS_BANK_SELECT, array_values)}
         self.SetLights(led_map, rgb=rgb)
 
+    def NumWrites(self):
+        """ Returns the number of times lights were set so far. """
+        return self._num_writes
+
+    def NoteCommandSent(self, payload):
+        """ Update the framebuffers with a light command that was sent to the device without going through this
+        instance, such as one forwarded from the other script.
+
+        :param payload: the command payload. Payloads that are not light commands are ignored.
+        """
+        command = bytes(payload[:3])
+        if len(payload) >= 4 and command in (ArturiaLights.SET_MONOCHROME_LIGHT_COMMAND,
+                                             ArturiaLights.SET_RGB_LIGHT_COMMAND):
+            self._sent_ms[payload[3]] = self._clock.time_ms()
+        if command == ArturiaLights.SET_MONOCHROME_LIGHT_COMMAND and len(payload) >= 5:
+            led_id = payload[3]
+            self._mono_framebuffer[led_id] = payload[4]
+            self._rgb_framebuffer[3 * led_id] = _UNKNOWN
+        elif command == ArturiaLights.SET_RGB_LIGHT_COMMAND and len(payload) >= 7:
+            led_id = payload[3]
+            self._rgb_framebuffer[3 * led_id:3 * led_id + 3] = bytes(payload[4:7])
+            self._mono_framebuffer[led_id] = _UNKNOWN
+        else:
+            return
+        self._num_writes += 1
+
+    def counters(self):
+        """ Returns the SysexCounters for the LED messages. """
+        return self._counters
+
+    def Invalidate(self, led_ids=None):
+        """ Forget what the keyboard shows so that the next value set for the LEDs is sent.
+
+        :param led_ids: ids of the LEDs that may have been changed by the keyboard itself, or None for all LEDs.
+        """
+        if led_ids is None:
+            led_ids = range(_NUM_LED_IDS)
+        for led_id in led_ids:
+            self._mono_framebuffer[led_id] = _UNKNOWN
+            self._rgb_framebuffer[3 * led_id] = _UNKNOWN
+        # Animations send whole frames again after a write they did not make.
+        self._num_writes += 1
+
+    def _is_shown(self, led_id, led_value, rgb, time_ms):
+        # Returns True if the framebuffer says that the LED already shows the value, and was sent recently enough to
+        # trust it.
+        if time_ms - self._sent_ms[led_id] >= MAX_MS_BETWEEN_IDENTICAL_LED_VALUES:
+            return False
+        if rgb:
+            pos = 3 * led_id
+            return self._rgb_framebuffer[pos:pos + 3] == bytes(ArturiaLights.int2rgb(led_value))
+        return self._mono_framebuffer[led_id] == led_value
+
+    @staticmethod
+    def _message_size(rgb):
+        return ArturiaLights._RGB_MESSAGE_SIZE if rgb else ArturiaLights._MONOCHROME_MESSAGE_SIZE
+
     def SetLights(self, led_mapping, rgb=False):
-        """ Given a map of LED ids to color value, construct and send a command with all the led mapping. """
-        time_ms = time.monotonic() * 1000
+        """ Given a map of LED ids to color value, queue a command for each LED whose value changed.
+
+        Queued commands are sent from the scheduler at no more than the configured rate, so this returns immediately.
+        """
+        self._num_writes += 1
+        time_ms = self._clock.time_ms()
+        queue = self._queue
+        queued = False
         for led_id, led_value in led_mapping.items():
             if led_id == ArturiaLights.MISSING:
                 # Do not toggle/set lights that are missing
                 continue
-            if led_id not in self._last_send_ms:
-                self._last_send_ms[led_id] = 0
-
-            if time_ms - self._last_send_ms[led_id] < 33:
-                # Drop value
+            if led_id in queue:
+                # The queued value is never sent.
+                self._counters.RecordSkipped(ArturiaLights._message_size(queue[led_id][1]))
+            elif self._is_shown(led_id, led_value, rgb, time_ms):
+                self._counters.RecordSkipped(ArturiaLights._message_size(rgb))
                 continue
-            self._last_send_ms[led_id] = time_ms
-            if rgb:
-                r, g, b = ArturiaLights.int2rgb(led_value)
-                self._send_fn(ArturiaLights.SET_RGB_LIGHT_COMMAND + bytes([led_id, r, g, b]))
-            else:
-                self._send_fn(ArturiaLights.SET_MONOCHROME_LIGHT_COMMAND + bytes([led_id, led_value]))
-            # Need to intentionally sleep to allow time for keyboard to process command sent.
-            time.sleep(0.0001)
+            queue[led_id] = (led_value, rgb)
+            queued = True
+        if queued:
+            self._schedule_drain(time_ms)
+
+    def NumQueued(self):
+        """ Returns the number of LEDs with a value waiting to be sent. """
+        return len(self._queue)
+
+    def _schedule_drain(self, time_ms):
+        # Schedules the task that sends the queued values for when the rate allows the next message. The task is keyed,
+        # so this replaces an already scheduled one.
+        wait_ms = self._virtual_send_ms - self._max_ahead_ms - time_ms
+        # Rounded up to the next whole millisecond so that the task never runs just before the message is allowed.
+        delay = int(wait_ms) + 1 if wait_ms > 0 else 0
+        self._scheduler.ScheduleTask(self._drain, delay=delay, key=self, label='led update')
+
+    def _drain(self):
+        time_ms = self._clock.time_ms()
+        queue = self._queue
+        num_sent = 0
+        while queue and self._virtual_send_ms - time_ms <= self._max_ahead_ms:
+            led_id = next(iter(queue))
+            led_value, rgb = queue.pop(led_id)
+            if self._send_light(led_id, led_value, rgb, time_ms):
+                self._virtual_send_ms = max(self._virtual_send_ms, time_ms) + self._ms_per_message
+                num_sent += 1
+        if num_sent and self._flush_fn is not None:
+            self._flush_fn()
+        if queue:
+            self._schedule_drain(time_ms)
+
+    def _send_light(self, led_id, led_value, rgb, time_ms):
+        # Returns True if a message was sent.
+        if self._is_shown(led_id, led_value, rgb, time_ms):
+            # The LED was set back to what it shows while the value was queued.
+            self._counters.RecordSkipped(ArturiaLights._message_size(rgb))
+            return False
+        pos = 3 * led_id
+        self._sent_ms[led_id] = time_ms
+        if rgb:
+            r, g, b = ArturiaLights.int2rgb(led_value)
+            self._send_fn(ArturiaLights.SET_RGB_LIGHT_COMMAND + bytes([led_id, r, g, b]))
+            self._rgb_framebuffer[pos:pos + 3] = bytes([r, g, b])
+            self._mono_framebuffer[led_id] = _UNKNOWN
+            self._counters.RecordSent(ArturiaLights._RGB_MESSAGE_SIZE)
+        else:
+            self._send_fn(ArturiaLights.SET_MONOCHROME_LIGHT_COMMAND + bytes([led_id, led_value]))
+            self._mono_framebuffer[led_id] = led_value
+            self._rgb_framebuffer[pos] = _UNKNOWN
+            self._counters.RecordSent(ArturiaLights._MONOCHROME_MESSAGE_SIZE)
+        return True
@@ -1,3 +1,4 @@
+from arturia_animation import LedAnimation
 from arturia_leds import ArturiaLights
 
 import arturia_leds
@@ -9,12 +10,49 @@ import ui
 
 
 class VisualMetronome:
-    """ Manages animating button lights when song/pattern is playing so that user has a visual metronome. """
-    def __init__(self, lights):
+    """ Manages animating button lights when song/pattern is playing so that user has a visual metronome.
+
+    The lights are played as an animation with one frame per pad, stepped by the beat indicator: the pad of the current
+    beat (column) and bar (row) is lit and the rewind/forward lights alternate on every beat. The frame table is built
+    for the pad layout and the selected channel color, and only rebuilt after Invalidate when these have changed, so a
+    beat costs a frame lookup and sending the LEDs that changed.
+    """
+    # Name of the animation the metronome plays.
+    ANIMATION_NAME = 'metronome'
+
+    def __init__(self, lights, animator):
         self._beat_count = 0
         self._bar_count = -1  # First beat is always a bar, so this needs to get incremented to 0
         self._lights = lights
+        self._animator = animator
         self._last_bst_position = (1, 0, 1)
+        self._num_rows = len(ArturiaLights.MATRIX_IDS_PAD)
+        self._num_cols = len(ArturiaLights.MATRIX_IDS_PAD[0])
+        # Values the animation was built for, to rebuild it when they change.
+        self._animation_key = None
+        # Whether the lights are shown, as last read from FL Studio.
+        self._enabled = True
+        # True if FL Studio state may have changed since it was last read.
+        self._stale = True
+
+    def _build_animation(self, zero_val, on_val, rgb):
+        pad_ids = [led_id for row in ArturiaLights.MATRIX_IDS_PAD for led_id in row]
+        num_cols = len(ArturiaLights.MATRIX_IDS_PAD[0])
+        led_ids = []
+        if config.ENABLE_PAD_METRONOME_LIGHTS:
+            led_ids.extend(pad_ids)
+        if config.ENABLE_TRANSPORTS_METRONOME_LIGHTS:
+            led_ids.extend([ArturiaLights.ID_TRANSPORTS_REWIND, ArturiaLights.ID_TRANSPORTS_FORWARD])
+        frames = []
+        for i in range(len(pad_ids)):
+            frame = []
+            if config.ENABLE_PAD_METRONOME_LIGHTS:
+                frame.extend(on_val if j == i else zero_val for j in range(len(pad_ids)))
+            if config.ENABLE_TRANSPORTS_METRONOME_LIGHTS:
+                two_step = (i % num_cols) % 2 == 0
+                frame.extend([ArturiaLights.AsOnOffByte(two_step), ArturiaLights.AsOnOffByte(not two_step)])
+            frames.append(frame)
+        return LedAnimation(led_ids, frames, rgb_led_ids=pad_ids if rgb else ())
 
     def Reset(self):
         """ Resets the metronome so that it begins from a rewinded playback state. """
@@ -26,10 +64,15 @@ class VisualMetronome:
             ArturiaLights.ID_TRANSPORTS_FORWARD: ArturiaLights.LED_OFF,
         })
 
-    def ProcessBeat(self, value):
-        """ Notify the metronome that a beat occured (e.g. OnUpdateBeatIndicator). """
-        if config.METRONOME_LIGHTS_ONLY_WHEN_METRONOME_ENABLED and not ui.isMetronomeEnabled():
-            # Disable metronome if configured to correlate to metronome toggle and is disabled.
+    def Invalidate(self):
+        """ Read the metronome toggle and selected channel color from FL Studio again on the next beat. """
+        self._stale = True
+
+    def _refresh(self):
+        self._stale = False
+        # Disable metronome if configured to correlate to metronome toggle and is disabled.
+        self._enabled = not config.METRONOME_LIGHTS_ONLY_WHEN_METRONOME_ENABLED or ui.isMetronomeEnabled()
+        if not self._enabled:
             return
 
         should_color_pads = ((not arturia_leds.ESSENTIAL_KEYBOARD and config.ENABLE_MK2_COLORIZE_PAD_LIGHTS) or
@@ -39,10 +82,20 @@ class VisualMetronome:
         if should_color_pads:
             channel_idx = channels.selectedChannel()
             color_val = channels.getChannelColor(channel_idx)
-            zero_val = ArturiaLights.fadedColor(color_val)
-            on_val = ArturiaLights.fullColor(color_val)
+            zero_val, on_val = ArturiaLights.channelColors(color_val)
+
+        animation_key = (zero_val, on_val, should_color_pads)
+        if animation_key != self._animation_key or not self._animator.IsPlaying(VisualMetronome.ANIMATION_NAME):
+            self._animator.Play(VisualMetronome.ANIMATION_NAME, self._build_animation(*animation_key))
+            self._animation_key = animation_key
+
+    def ProcessBeat(self, value):
+        """ Notify the metronome that a beat occured (e.g. OnUpdateBeatIndicator). """
+        if self._stale:
+            self._refresh()
+        if not self._enabled:
+            return
 
-        lights = ArturiaLights.ZeroMatrix(zero=zero_val)
         current_bst_position = (playlist.getVisTimeBar(),
                                 playlist.getVisTimeStep(),
                                 playlist.getVisTimeTick())
@@ -60,19 +113,7 @@ class VisualMetronome:
             self._beat_count = 0
             self._bar_count += 1
 
-        num_rows = len(lights)
-        num_cols = len(lights[0])
         if value != 0:
-            row = self._bar_count % num_rows
-            col = self._beat_count % num_cols
-            lights[row][col] = on_val
-            two_step = self._beat_count % 2 == 0
-
-            if config.ENABLE_PAD_METRONOME_LIGHTS:
-                self._lights.SetPadLights(lights, rgb=should_color_pads)
-
-            if config.ENABLE_TRANSPORTS_METRONOME_LIGHTS:
-                self._lights.SetLights({
-                    ArturiaLights.ID_TRANSPORTS_REWIND: ArturiaLights.AsOnOffByte(two_step),
-                    ArturiaLights.ID_TRANSPORTS_FORWARD: ArturiaLights.AsOnOffByte(not two_step),
-                })
+            row = self._bar_count % self._num_rows
+            col = self._beat_count % self._num_cols
+            self._animator.ShowFrame(VisualMetronome.ANIMATION_NAME, row * self._num_cols + col)
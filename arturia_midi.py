@@ -1,6 +1,8 @@
 import debug
 import device
 
+from arturia_scheduler import PRIORITY_BEST_EFFORT, PRIORITY_NORMAL
+
 # Status command to use when sending commands between scripts
 INTER_SCRIPT_STATUS_BYTE = 0x00
 INTER_SCRIPT_DATA1_BTN_DOWN_CMD = 0x01     # Data2 contains the id of the button
@@ -8,9 +10,12 @@ INTER_SCRIPT_DATA1_BTN_UP_CMD = 0x02       # Data2 contains the id of the button
 INTER_SCRIPT_DATA1_UPDATE_STATE = 0x03     # Data2 contains the status of the update (INTER_SCRIPT_DATA2_STATE_...)
 INTER_SCRIPT_DATA1_IDLE_CMD = 0x04         # Data2 is ignored
 
-INTER_SCRIPT_DATA1_BEGIN_PAYLOAD_CMD = 0xFE
-INTER_SCRIPT_DATA1_END_PAYLOAD_CMD = 0xFF
-PAYLOAD_STATUS_BYTE = 0x01
+# Payloads for the other scripts are packed three 7-bit bytes per dispatched message, into status bytes 0x40-0x7F (see
+# pack_payloads). These stay below 0x80, so they can never be mistaken for a MIDI message from the keyboard.
+PACKED_PAYLOAD_STATUS_MARKER = 0x40
+PACKED_PAYLOAD_LAST_WORD_FLAG = 0x20
+# Maximum number of bytes in a single packed payload, as the length is sent in one 7-bit byte.
+MAX_PACKED_PAYLOAD_SIZE = 0x7F
 PLUGIN_PORT_NUM = 10
 SYSEX_HEADER = [0xF0, 0x00, 0x20, 0x6B, 0x7F, 0x42]
 SYSEX_FOOTER = [0xF7]
@@ -18,6 +23,16 @@ SYSEX_FOOTER = [0xF7]
 INTER_SCRIPT_DATA2_STATE_PAD_RECORD_STOP = 0x00
 INTER_SCRIPT_DATA2_STATE_PAD_RECORD_START = 0x01
 INTER_SCRIPT_DATA2_STATE_IDLE_AVAILABLE = 0x02
+INTER_SCRIPT_DATA2_STATE_DEVICE_MODE_CHANGED = 0x03
+
+# Number of microseconds needed to transmit a byte over the 31.25 kbaud MIDI link (8 data bits plus start/stop bits).
+MIDI_LINK_US_PER_BYTE = 320
+
+# All SysexCounters instances, so that they can be dumped together.
+_ALL_SYSEX_COUNTERS = []
+
+# MidiOutArbiter that send_to_device routes through, or None to send straight to the device.
+_output_arbiter = None
 
 
 class MidiEventDispatcher:
@@ -78,32 +93,343 @@ class MidiEventDispatcher:
         return processed
 
 
-def send_to_device(data):
-    """Sends a data payload to Arturia device. """
+class CompiledMidiEventDispatcher:
+    """ Dispatches MIDI events by (midiId, controlNum) through a single flat table.
+
+    Handlers are stored in a list with one entry per (message type, control number), so dispatching an event costs one
+    index computation and one call, without transform or filter functions. Handlers that ignore releases are folded in
+    as a separate table used for events with a zero control value.
+
+    Events whose midiId has no handler at all are not handled. Events whose midiId has handlers, but not for their
+    control number, are marked as handled and dropped, as nested MidiEventDispatchers do. Only channel message types
+    (midiId 0x80 to 0xF0) have a row in the table: events with a lower midiId, such as the messages the scripts
+    dispatch to each other, are never handled.
+    """
+    # Number of table entries: 8 channel message types (midiId 0x80 to 0xF0) times 128 control numbers.
+    _TABLE_SIZE = 8 * 128
+
+    def __init__(self):
+        # Tables of index -> function called with the event, or None if the midiId has no handler. Releases (events
+        # with a zero control value) are dispatched through the release table, all other events through the press one.
+        self._press_table = [None] * CompiledMidiEventDispatcher._TABLE_SIZE
+        self._release_table = [None] * CompiledMidiEventDispatcher._TABLE_SIZE
+
+    @staticmethod
+    def _index(midi_id, control_num):
+        return ((midi_id & 0x70) << 3) | (control_num & 0x7F)
+
+    def _claim_midi_id(self, midi_id):
+        # Make events of midi_id without a handler for their control number be handled and dropped.
+        start = CompiledMidiEventDispatcher._index(midi_id, 0)
+        for index in range(start, start + 128):
+            if self._press_table[index] is None:
+                self._press_table[index] = self._drop_unknown
+                self._release_table[index] = self._drop_unknown
+
+    def SetHandler(self, midi_id, control_num, callback_fn, ignore_release=False):
+        """ Associate a handler function to a (midiId, controlNum) pair.
+
+        :param midi_id: the midiId of the events to handle.
+        :param control_num: the controlNum of the events to handle.
+        :param callback_fn: function that is called with the matching events.
+        :param ignore_release: if True, events with a zero control value are marked as handled and dropped instead of
+            being passed to callback_fn.
+        """
+        if not 0x80 <= midi_id <= 0xFF:
+            raise ValueError('midiId 0x%X is not a channel message type' % midi_id)
+        self._claim_midi_id(midi_id)
+        index = CompiledMidiEventDispatcher._index(midi_id, control_num)
+        self._press_table[index] = callback_fn
+        self._release_table[index] = self._drop_release if ignore_release else callback_fn
+        return self
+
+    def SetHandlerForKeys(self, midi_id, control_nums, callback_fn, ignore_release=False):
+        """ Associate the same handler for a group of control numbers. See SetHandler for more details. """
+        for control_num in control_nums:
+            self.SetHandler(midi_id, control_num, callback_fn, ignore_release=ignore_release)
+        return self
+
+    def SetHandlerForAllControls(self, midi_id, callback_fn):
+        """ Associate a handler for every event of a midiId, whatever its control number. """
+        for control_num in range(128):
+            self.SetHandler(midi_id, control_num, callback_fn)
+        return self
+
+    @staticmethod
+    def _drop_release(event):
+        if debug.ENABLED:
+            debug.log("DISPATCHER", "Event dropped by filter.", event=event)
+
+    @staticmethod
+    def _drop_unknown(event):
+        if debug.ENABLED:
+            debug.log("DISPATCHER", "No handler found.", event=event)
+
+    def Dispatch(self, event):
+        """ Dispatches a midi event to the appropriate listener.
+
+        :param event:  the event to dispatch.
+        :return: True if the event was handled.
+        """
+        midi_id = event.midiId
+        if midi_id < 0x80:
+            # Would alias the row of a channel message type.
+            handler = None
+        else:
+            table = self._press_table if event.controlVal else self._release_table
+            handler = table[((midi_id & 0x70) << 3) | (event.controlNum & 0x7F)]
+        if handler is None:
+            if debug.ENABLED:
+                debug.log("DISPATCHER", "No handler found.", event=event)
+            return False
+        event.handled = True
+        handler(event)
+        return True
+
+
+def sysex_size(data):
+    """ Returns the number of bytes send_to_device puts on the wire for the given data payload. """
+    return len(SYSEX_HEADER) + len(data) + len(SYSEX_FOOTER)
+
+
+class SysexCounters:
+    """ Counts the SysEx traffic a component sends to the device and the traffic it avoided sending.
+
+    A frame is skipped when it is identical to what the device already shows. Bytes saved counts both skipped frames
+    and the part of a frame left out when only the changed portion is sent.
+    """
+    def __init__(self, name):
+        self._name = name
+        self.Reset()
+        _ALL_SYSEX_COUNTERS.append(self)
+
+    def Reset(self):
+        self.frames_sent = 0
+        self.frames_skipped = 0
+        self.bytes_sent = 0
+        self.bytes_saved = 0
+
+    def RecordSent(self, num_bytes, num_bytes_saved=0):
+        self.frames_sent += 1
+        self.bytes_sent += num_bytes
+        self.bytes_saved += num_bytes_saved
+
+    def RecordSkipped(self, num_bytes_saved):
+        self.frames_skipped += 1
+        self.bytes_saved += num_bytes_saved
+
+    def Format(self):
+        """ Returns the counters as a printable line. """
+        return '[%s] frames sent=%d skipped=%d, bytes sent=%d saved=%d (%.1f ms of link time saved)' % (
+            self._name, self.frames_sent, self.frames_skipped, self.bytes_sent, self.bytes_saved,
+            self.bytes_saved * MIDI_LINK_US_PER_BYTE / 1000)
+
+
+def DumpAllSysexCounters():
+    """ Print the SysEx counters of every component to the script output. """
+    for counters in _ALL_SYSEX_COUNTERS:
+        print(counters.Format())
+
+
+class MidiOutArbiter:
+    """ Shares the SysEx output to the device between all components within a byte-rate budget.
+
+    The budget is a token bucket: bytes may be sent in a burst of up to burst_bytes, and are otherwise replenished at
+    bytes_per_second. Messages that do not fit are queued and sent from the scheduler, highest priority first and in
+    order within a priority, as soon as the bucket allows. Over any window of T milliseconds at most
+    burst_bytes + bytes_per_second * T / 1000 bytes are sent, as long as no message exceeds burst_bytes.
+    """
+    def __init__(self, scheduler, bytes_per_second, burst_bytes, send_fn=None):
+        """ Create an arbiter.
+
+        :param scheduler: Scheduler used to send queued messages once the budget allows. Its clock is used for timing.
+        :param bytes_per_second: rate at which the budget is replenished.
+        :param burst_bytes: maximum number of bytes that may be sent back to back.
+        :param send_fn: function called with the complete SysEx message to send. Defaults to device.midiOutSysex.
+        """
+        if send_fn is None:
+            send_fn = device.midiOutSysex
+        self._scheduler = scheduler
+        self._clock = scheduler.clock()
+        self._bytes_per_ms = bytes_per_second / 1000
+        self._burst_bytes = burst_bytes
+        self._send_fn = send_fn
+        self._tokens = burst_bytes
+        self._tokens_time_ms = self._clock.time_ms()
+        # Queued messages for each priority, indexed by priority. Each entry is a (message, key) tuple.
+        self._queues = [[] for _ in range(PRIORITY_BEST_EFFORT + 1)]
+        # Mapping of key -> queued entry, so that a newer message replaces a queued one with the same key.
+        self._keyed = {}
+        self._drain_fn = self._drain
+
+    def NumQueued(self):
+        """ Returns the number of messages waiting for budget. """
+        return sum(len(queue) for queue in self._queues)
+
+    def Send(self, message, priority=PRIORITY_NORMAL, key=None):
+        """ Send a complete SysEx message now if the budget allows it, otherwise queue it.
+
+        :param message: bytes of the message to send.
+        :param priority: PRIORITY_REALTIME, PRIORITY_NORMAL or PRIORITY_BEST_EFFORT from arturia_scheduler.
+        :param key: if set, drops a message still queued under the same key. The new message is queued behind any
+            other queued messages, so that it is never overtaken by messages that were sent before it.
+        """
+        entry = (message, key)
+        if key is not None:
+            stale = self._keyed.get(key)
+            if stale is not None:
+                for queue in self._queues:
+                    if stale in queue:
+                        queue.remove(stale)
+                        break
+            self._keyed[key] = entry
+        self._queues[priority].append(entry)
+        self._drain()
+
+    def _refill(self):
+        time_ms = self._clock.time_ms()
+        self._tokens = min(self._burst_bytes, self._tokens + (time_ms - self._tokens_time_ms) * self._bytes_per_ms)
+        self._tokens_time_ms = time_ms
+
+    def _drain(self):
+        self._refill()
+        for queue in self._queues:
+            while queue:
+                entry = queue[0]
+                size = len(entry[0])
+                # A message larger than the burst is sent once the bucket is full and leaves the bucket in debt.
+                needed = min(size, self._burst_bytes)
+                if self._tokens < needed:
+                    # Round the wait up to a whole millisecond so that the budget has surely been replenished.
+                    delay = int((needed - self._tokens) / self._bytes_per_ms) + 1
+                    self._scheduler.ScheduleTask(self._drain_fn, delay=delay, key=self, label='midi out')
+                    return
+                del queue[0]
+                if entry[1] is not None:
+                    del self._keyed[entry[1]]
+                self._tokens -= size
+                self._send_fn(entry[0])
+
+
+def set_output_arbiter(arbiter):
+    """ Route all future send_to_device calls through arbiter, or straight to the device if arbiter is None. """
+    global _output_arbiter
+    _output_arbiter = arbiter
+
+
+def send_to_device(data, priority=PRIORITY_NORMAL, key=None):
+    """Sends a data payload to Arturia device.
+
+    :param data: payload to wrap in the Arturia SysEx header and footer.
+    :param priority: priority of the payload when the output is shared through a MidiOutArbiter.
+    :param key: if set, a newer payload with the same key replaces this one while it waits for output budget.
+    """
     # debug.log('CMD', 'Sending payload: ' + str(data))
     # Reference regarding SysEx code : # https://forum.arturia.com/index.php?topic=90496.0
-    device.midiOutSysex(bytes(SYSEX_HEADER) + bytes(data) + bytes(SYSEX_FOOTER))
+    message = bytes(SYSEX_HEADER) + bytes(data) + bytes(SYSEX_FOOTER)
+    if _output_arbiter is None:
+        device.midiOutSysex(message)
+    else:
+        _output_arbiter.Send(message, priority=priority, key=key)
 
 
 def dispatch_message_to_other_scripts(status, data1, data2, payload=None):
     """ Sends midi commands to other scripts scripts. """
+    if payload is not None:
+        dispatch_payloads_to_other_scripts([payload])
+        return
+    msg = status + (data1 << 8) + (data2 << 16)
     for i in range(device.dispatchReceiverCount()):
-        msg = status + (data1 << 8) + (data2 << 16)
-        if payload is None:
-            device.dispatch(i, msg)
-        else:
-            msg = INTER_SCRIPT_DATA1_BEGIN_PAYLOAD_CMD
-            msg += (INTER_SCRIPT_DATA1_BEGIN_PAYLOAD_CMD << 8)
-            device.dispatch(i, msg)
+        device.dispatch(i, msg)
 
-            # Send payload
-            for j in range(0, len(payload), 2):
-                msg = PAYLOAD_STATUS_BYTE + (payload[j] << 8)
-                if j + 1 < len(payload):
-                   msg += (payload[j + 1] << 16)
-                device.dispatch(i, msg)
 
-            msg = INTER_SCRIPT_STATUS_BYTE
-            msg += (INTER_SCRIPT_DATA1_END_PAYLOAD_CMD << 8)
+def dispatch_payloads_to_other_scripts(payloads):
+    """ Sends a list of payloads to the other scripts, packed together into as few messages as possible. """
+    words = pack_payloads(payloads)
+    for i in range(device.dispatchReceiverCount()):
+        for msg in words:
             device.dispatch(i, msg)
 
+
+def is_packed_payload(status):
+    """ Returns True if a message with this status byte carries part of packed payloads. """
+    return status & 0xC0 == PACKED_PAYLOAD_STATUS_MARKER
+
+
+def pack_payloads(payloads):
+    """ Pack payloads into the messages dispatched to the other scripts.
+
+    The payloads are laid out back to back, each preceded by its length, and padded with zeros to a multiple of three
+    bytes. A zero length ends the payloads. Each group of three bytes b0, b1, b2 is then sent as one message with:
+      status = PACKED_PAYLOAD_STATUS_MARKER | (b2 >> 2), plus PACKED_PAYLOAD_LAST_WORD_FLAG on the last message
+      data1  = b0 | (bit 0 of b2) << 7
+      data2  = b1 | (bit 1 of b2) << 7
+    Payload bytes are SysEx data, so only their low 7 bits are kept. Bits 24-31 of the message are left unused, as FL
+    Studio's device.dispatch drops them and delivers only the status, data1 and data2 bytes to the other scripts.
+
+    :param payloads: list of payloads of 1 to MAX_PACKED_PAYLOAD_SIZE bytes.
+    :return: list of messages to dispatch, in order.
+    """
+    stream = bytearray()
+    for payload in payloads:
+        if len(payload) > MAX_PACKED_PAYLOAD_SIZE:
+            raise ValueError('Payload of %d bytes is too large to pack' % len(payload))
+        if payload:
+            stream.append(len(payload))
+            stream.extend(b & 0x7F for b in payload)
+    stream.extend(bytes(-len(stream) % 3))
+    words = []
+    for j in range(0, len(stream), 3):
+        b0, b1, b2 = stream[j], stream[j + 1], stream[j + 2]
+        words.append((PACKED_PAYLOAD_STATUS_MARKER | (b2 >> 2)) +
+                     ((b0 | (b2 & 0x01) << 7) << 8) +
+                     ((b1 | (b2 & 0x02) << 6) << 16))
+    if words:
+        words[-1] |= PACKED_PAYLOAD_LAST_WORD_FLAG
+    return words
+
+
+class InterScriptPayloadBatcher:
+    """ Collects payloads for the other scripts and dispatches them together on Flush.
+
+    Payloads dispatched together share messages, so batching the LED commands sent in one go (as the send and flush
+    functions of ArturiaLights) takes fewer dispatches than sending each one on its own.
+    """
+    def __init__(self):
+        self._payloads = []
+
+    def Add(self, payload):
+        """ Queue a payload to dispatch on the next Flush. """
+        self._payloads.append(payload)
+
+    def Flush(self):
+        """ Dispatch the queued payloads to the other scripts. """
+        if self._payloads:
+            dispatch_payloads_to_other_scripts(self._payloads)
+            self._payloads = []
+
+
+class InterScriptPayloadDecoder:
+    """ Reassembles the payloads packed by pack_payloads from the messages a script receives. """
+    def __init__(self):
+        self._stream = bytearray()
+
+    def Feed(self, status, data1, data2):
+        """ Feed a message for which is_packed_payload(status) is True.
+
+        :return: the list of payloads if this was the last message of a batch, otherwise None.
+        """
+        stream = self._stream
+        stream.append(data1 & 0x7F)
+        stream.append(data2 & 0x7F)
+        stream.append(((status & 0x1F) << 2) | ((data2 >> 6) & 0x02) | ((data1 >> 7) & 0x01))
+        if not status & PACKED_PAYLOAD_LAST_WORD_FLAG:
+            return None
+        payloads = []
+        pos = 0
+        while pos < len(stream) and stream[pos] != 0:
+            size = stream[pos]
+            payloads.append(bytes(stream[pos + 1:pos + 1 + size]))
+            pos += 1 + size
+        self._stream = bytearray()
+        return payloads
@@ -0,0 +1,146 @@
+""" Stress test of the MidiOutArbiter byte budget against a stand-in of the FL Studio device module.
+
+This runs outside of FL Studio, from the script folder:
+
+    python arturia_midi_out_stress.py
+
+The arbiter is the one guard against flooding the keyboard with SysEx (see arturia_display), so this drives it on a
+virtual clock with random traffic of all priorities, keyed and not, in quiet stretches and in bursts far over the
+budget. The traffic takes the path of the scripts: send_to_device, the arbiter installed with set_output_arbiter, then
+device.midiOutSysex of the device module stand-in, where the messages are recorded. It then checks that:
+  - over every window of T milliseconds, at most burst_bytes + bytes_per_second * T / 1000 bytes were sent,
+  - every message without a key was sent, in order within its priority,
+  - the latest message of each key was sent.
+The script exits with an error on the first check that fails.
+"""
+import argparse
+import random
+import sys
+
+from arturia_standins import StandInModule
+
+# Messages the device module stand-in was asked to send, as (timestamp ms, message), and the clock to timestamp them
+# with. Installed before the script modules are loaded, as they import the device module.
+_sent = []
+_clock = None
+sys.modules['device'] = StandInModule('device', {
+    'getName': lambda: 'Arturia KeyLab mkII 61',
+    'midiOutSysex': lambda message: _sent.append((_clock.time_ms(), message)),
+}, {})
+
+import arturia_midi
+import config
+
+from arturia_clock import VirtualClock
+from arturia_midi import MidiOutArbiter, SYSEX_HEADER, send_to_device
+from arturia_scheduler import PRIORITY_BEST_EFFORT, PRIORITY_NORMAL, PRIORITY_REALTIME, Scheduler
+
+# Sizes in bytes of the payloads sent, which send_to_device wraps into messages 7 bytes longer. These are roughly the
+# sizes of LED, small and full display messages.
+_PAYLOAD_SIZES = (4, 6, 9, 33, 48)
+# Keys that messages may be sent with, like the display and the LED update tasks use.
+_KEYS = ('display', 'leds', 'hint')
+# Milliseconds between two calls to Idle, like FL Studio's OnIdle.
+_IDLE_INTERVALS_MS = (0.1, 1, 5, 20)
+
+
+def _payload(priority, serial, size):
+    # Encodes the priority and a serial number into the payload so that its message can be told apart once sent.
+    header = bytes([priority, (serial >> 14) & 0x7F, (serial >> 7) & 0x7F, serial & 0x7F])
+    return header + bytes(size - len(header))
+
+
+def _priority(message):
+    return message[len(SYSEX_HEADER)]
+
+
+def _serial(message):
+    pos = len(SYSEX_HEADER)
+    return (message[pos + 1] << 14) | (message[pos + 2] << 7) | message[pos + 3]
+
+
+def max_window_excess(sent, bytes_per_second, burst_bytes, window_ms):
+    """ Returns by how many bytes the most loaded window exceeds the budget. Zero or less means it never did.
+
+    :param sent: list of (timestamp ms, size) of the sent messages, in order.
+    :param window_ms: longest window to check. All windows starting at a send, up to this long, are checked.
+    """
+    worst = float('-inf')
+    for i in range(len(sent)):
+        start_ms = sent[i][0]
+        total = 0
+        for j in range(i, len(sent)):
+            time_ms, size = sent[j]
+            if time_ms - start_ms > window_ms:
+                break
+            total += size
+            worst = max(worst, total - (burst_bytes + bytes_per_second * (time_ms - start_ms) / 1000))
+    return worst
+
+
+def run(seed, num_steps, bytes_per_second, burst_bytes, window_ms):
+    """ Run one randomized session and check its output. Raises AssertionError if a check fails.
+
+    :return: (number of messages queued, number of messages sent, worst window excess in bytes).
+    """
+    global _clock
+    rng = random.Random(seed)
+    clock = _clock = VirtualClock(start_ms=1000)
+    scheduler = Scheduler(clock=clock)
+    sent = _sent
+    del sent[:]
+    arbiter = MidiOutArbiter(scheduler, bytes_per_second, burst_bytes)
+    arturia_midi.set_output_arbiter(arbiter)
+    # Serial numbers of the messages without a key for each priority, and of the latest message of each key.
+    unkeyed = {PRIORITY_REALTIME: [], PRIORITY_NORMAL: [], PRIORITY_BEST_EFFORT: []}
+    latest_keyed = {}
+    keyed = set()
+    serial = 0
+    for _ in range(num_steps):
+        # Mostly quiet, with the occasional burst well over the budget.
+        for _ in range(rng.choice((0,) * 60 + (1, 1, 2, 30))):
+            priority = rng.choice((PRIORITY_REALTIME, PRIORITY_NORMAL, PRIORITY_BEST_EFFORT))
+            key = rng.choice(_KEYS) if rng.random() < 0.3 else None
+            send_to_device(_payload(priority, serial, rng.choice(_PAYLOAD_SIZES)), priority=priority, key=key)
+            if key is None:
+                unkeyed[priority].append(serial)
+            else:
+                latest_keyed[key] = serial
+                keyed.add(serial)
+            serial += 1
+        clock.Advance(rng.choice(_IDLE_INTERVALS_MS))
+        scheduler.Idle()
+    while arbiter.NumQueued():
+        clock.AdvanceTo(scheduler.NextTaskTimeMs())
+        scheduler.Idle()
+    arturia_midi.set_output_arbiter(None)
+
+    excess = max_window_excess([(time_ms, len(message)) for time_ms, message in sent], bytes_per_second,
+                               burst_bytes, window_ms)
+    assert excess <= 1e-6, 'seed %d: a window of up to %d ms went %.1f bytes over budget' % (seed, window_ms, excess)
+    for priority, serials in unkeyed.items():
+        sent_serials = [_serial(message) for _, message in sent
+                        if _priority(message) == priority and _serial(message) not in keyed]
+        assert sent_serials == serials, 'seed %d: priority %d messages lost or reordered' % (seed, priority)
+    sent_keyed = set(_serial(message) for _, message in sent) & keyed
+    assert set(latest_keyed.values()) <= sent_keyed, 'seed %d: the latest message of a key was dropped' % seed
+    return serial, len(sent), excess
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stress test the MidiOutArbiter byte budget.')
+    parser.add_argument('--seeds', type=int, default=10, help='number of randomized sessions to run')
+    parser.add_argument('--steps', type=int, default=5000, help='number of Idle calls per session')
+    parser.add_argument('--bytes-per-second', type=float, default=config.MIDI_OUT_BYTES_PER_SECOND)
+    parser.add_argument('--burst-bytes', type=int, default=config.MIDI_OUT_BURST_BYTES)
+    parser.add_argument('--window-ms', type=int, default=500, help='longest window the budget is checked over')
+    args = parser.parse_args(argv)
+    for seed in range(args.seeds):
+        num_queued, num_sent, excess = run(seed, args.steps, args.bytes_per_second, args.burst_bytes, args.window_ms)
+        print('seed %d: %d messages queued, %d sent, %.1f bytes of headroom in the most loaded window' % (
+            seed, num_queued, num_sent, max(0.0, -excess)))
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
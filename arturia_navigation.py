@@ -38,4 +38,6 @@ class NavigationMode:
         self._refresh()
 
     def _refresh(self):
+        # The mode or its value was just changed by the user, so do not wait for FL Studio to report the change.
+        self._paged_display.Invalidate()
         self._paged_display.SetActivePage(self._modes[self._active_index][0], expires=self._display_ms)
\ No newline at end of file
@@ -1,69 +1,130 @@
-from arturia_display import ArturiaDisplay
+from arturia_scheduler import PRIORITY_BEST_EFFORT
+
+
+class _Page:
+    """ Line providers of a page, along with the lines they last returned. """
+    __slots__ = ('line1', 'line2', 'line1_cache', 'line2_cache')
+
+    def __init__(self):
+        # Functions returning the string for each line, or None if the page does not set the line.
+        self.line1 = None
+        self.line2 = None
+        # (epoch, string) last returned by each line provider, or None if not queried since the provider was set.
+        self.line1_cache = None
+        self.line2_cache = None
 
 
 class ArturiaPagedDisplay:
     def __init__(self, display, scheduler):
         self._display = display
         self._scheduler = scheduler
-        # Mapping of page name string to line 1 string provider function for that page.
-        self._line1 = {}
-        # Mapping of page name string to line 2 string provider function for that page.
-        self._line2 = {}
+        # Mapping of page name string to _Page.
+        self._pages = {}
+        # Incremented whenever FL state that providers read may have changed. Provider results are reused until then.
+        self._epoch = 0
         # Active page to display or None for default display
         self._active_page = None
-        # Temporary page to display or None for default display
-        self._ephemeral_page = None
-        # Timestamp after which to switch back to active page.
-        self._page_expiration_time_ms = 0
+        # Stack of temporary pages displayed over the active page, as an insertion ordered mapping of page name string
+        # to the timestamp in milliseconds at which the page stops being displayed. The last page is the top of the
+        # stack. It is displayed until it expires, then the page below it if that has not expired yet. A page is stacked
+        # at most once, so the stack never holds more entries than there are pages.
+        self._page_stack = {}
+        # Page that was displayed last.
+        self._visible_page = None
         # Last timestamp in milliseconds in which the text was updated.
         self._last_update_ms = 0
 
+    def _get_page(self, page_name):
+        page = self._pages.get(page_name)
+        if page is None:
+            page = self._pages[page_name] = _Page()
+        return page
+
     def SetPageLines(self, page_name, line1=None, line2=None, update=True):
+        page = self._get_page(page_name)
         if line1 is not None:
-            self._line1[page_name] = lambda: line1
+            page.line1 = lambda: line1
+            page.line1_cache = None
         if line2 is not None:
-            self._line2[page_name] = lambda: line2
-        if self._active_page == page_name and update:
+            page.line2 = lambda: line2
+            page.line2_cache = None
+        if self._visible_page == page_name and update:
             self._update_display(False)
 
     def SetPageLinesProvider(self, page_name, line1=None, line2=None):
+        """ Set functions that return the lines of a page.
+
+        Providers are only called again after Invalidate, so they should only depend on state whose changes lead to
+        an Invalidate call.
+        """
+        page = self._get_page(page_name)
         if line1 is not None:
-            self._line1[page_name] = line1
+            page.line1 = line1
+            page.line1_cache = None
         if line2 is not None:
-            self._line2[page_name] = line2
-        if self._active_page == page_name:
+            page.line2 = line2
+            page.line2_cache = None
+        if self._visible_page == page_name:
             self._update_display(False)
 
     def SetActivePage(self, page_name, expires=None):
-        reset_scroll = page_name != self._active_page
+        """ Display a page.
+
+        :param page_name: name of the page to display.
+        :param expires: if set, the page is pushed over the pages currently displayed for this many milliseconds instead
+            of becoming the active page. Pushing a page that is already stacked moves it to the top.
+        """
         if expires is not None:
-            reset_scroll = page_name != self._ephemeral_page
-            self._ephemeral_page = page_name
-            self._page_expiration_time_ms = ArturiaDisplay.time_ms() + expires
-            self._scheduler.ScheduleTask(lambda: self.Refresh(), delay=expires)
+            # Remove the page first so that it is re-inserted at the top of the stack.
+            self._page_stack.pop(page_name, None)
+            self._page_stack[page_name] = self._display.time_ms() + expires
         else:
             self._active_page = page_name
-        self._update_display(reset_scroll)
+        self._update_display(False)
 
     def display(self):
         return self._display
 
+    def Invalidate(self):
+        """ Discard the lines remembered from page providers so that they are queried again on the next update. """
+        self._epoch += 1
+
+    def _get_line(self, provider, cache):
+        # Returns the (line, cache) of a page line, calling its provider only if the line is not known for the
+        # current epoch.
+        if cache is not None and cache[0] == self._epoch:
+            return cache[1], cache
+        line = provider()
+        return line, (self._epoch, line)
+
+    def _pop_expired_pages(self, time_ms):
+        # Remove stacked pages that have expired, from the top down, and re-arm the expiry timer for the page now on
+        # top. The timer is keyed, so moving it later updates the pending task in place. Once the stack is empty, a
+        # pending timer is at most a redundant refresh, so it is left to run.
+        stack = self._page_stack
+        while stack and stack[next(reversed(stack))] <= time_ms:
+            stack.popitem()
+        if stack:
+            self._scheduler.ScheduleTask(self.Refresh, delay=stack[next(reversed(stack))] - time_ms, key=self,
+                                         label='page expiry', priority=PRIORITY_BEST_EFFORT)
+
     def _update_display(self, reset_scroll):
-        active_page = self._active_page
-        if reset_scroll:
-            self._display.ResetScroll()
+        self._last_update_ms = self._display.time_ms()
+        self._pop_expired_pages(self._last_update_ms)
+        active_page = next(reversed(self._page_stack)) if self._page_stack else self._active_page
 
-        self._last_update_ms = ArturiaDisplay.time_ms()
-        if self._last_update_ms < self._page_expiration_time_ms:
-            active_page = self._ephemeral_page
+        if reset_scroll or active_page != self._visible_page:
+            self._display.ResetScroll()
+        self._visible_page = active_page
 
-        if active_page is not None:
+        page = self._pages.get(active_page)
+        if page is not None:
             line1 = None
             line2 = None
-            if active_page in self._line1:
-                line1 = self._line1[active_page]()
-            if active_page in self._line2:
-                line2 = self._line2[active_page]()
+            if page.line1 is not None:
+                line1, page.line1_cache = self._get_line(page.line1, page.line1_cache)
+            if page.line2 is not None:
+                line2, page.line2_cache = self._get_line(page.line2, page.line2_cache)
             if line1:
                 line1 = line1[:16]
             if line2:
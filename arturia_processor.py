@@ -18,8 +18,7 @@ import transport
 import ui
 import utils
 
-from arturia_display import ArturiaDisplay
-from arturia_midi import MidiEventDispatcher
+from arturia_midi import CompiledMidiEventDispatcher
 from arturia_navigation import NavigationMode
 from arturia_leds import ArturiaLights
 from macro_actions import Actions
@@ -41,10 +40,6 @@ class ArturiaMidiProcessor:
         return event.controlVal != 0
 
     def __init__(self, controller):
-        def by_midi_id(event): return event.midiId
-        def by_control_num(event): return event.controlNum
-        def ignore_release(event): return self._is_pressed(event)
-
         self._controller = controller
         self._button_hold_action_committed = False
         self._button_mode = 0
@@ -53,51 +48,48 @@ class ArturiaMidiProcessor:
         self._mixer_plugins_visible = False
         self._mixer_plugins_last_track = 0
 
-        self._midi_id_dispatcher = (
-            MidiEventDispatcher(by_midi_id)
-            .SetHandler(144, self.OnCommandEvent)
-            .SetHandler(176, self.OnKnobEvent)
-            .SetHandler(224, self.OnSliderEvent))   # Sliders 1-9
-
-        self._midi_command_dispatcher = (
-            MidiEventDispatcher(by_control_num)
-            .SetHandler(91, self.OnTransportsBack)
-            .SetHandler(92, self.OnTransportsForward)
-            .SetHandler(93, self.OnTransportsStop)
-            .SetHandler(94, self.OnTransportsPausePlay)
-            .SetHandler(95, self.OnTransportsRecord)
-            .SetHandler(86, self.OnTransportsLoop)
-
-            .SetHandler(80, self.OnGlobalSave)
-            .SetHandler(87, self.OnGlobalIn, ignore_release)
-            .SetHandler(88, self.OnGlobalOut, ignore_release)
-            .SetHandler(89, self.OnGlobalMetro, ignore_release)
-            .SetHandler(81, self.OnGlobalUndo)
-
-            .SetHandlerForKeys(range(8, 16), self.OnTrackSolo, ignore_release)
-            .SetHandlerForKeys(range(16, 24), self.OnTrackMute, ignore_release)
-            .SetHandlerForKeys(range(0, 8), self.OnTrackRecord)
-
-            .SetHandler(74, self.OnTrackRead, ignore_release)
-            .SetHandler(75, self.OnTrackWrite, ignore_release)
-
-            .SetHandler(98, self.OnNavigationLeft)
-            .SetHandler(99, self.OnNavigationRight)
-            .SetHandler(84, self.OnNavigationKnobPressed, ignore_release)
-
-            .SetHandler(49, self.OnBankNext)
-            .SetHandler(48, self.OnBankPrev)
-            .SetHandler(47, self.OnLivePart1, ignore_release)
-            .SetHandler(46, self.OnLivePart2, ignore_release)
-
-            .SetHandlerForKeys(range(24, 32), self.OnBankSelect, ignore_release)
-            .SetHandlerForKeys(range(104, 112), self.OnStartOrEndSliderEvent)
-        )
-        self._knob_dispatcher = (
-            MidiEventDispatcher(by_control_num)
-            .SetHandlerForKeys(range(16, 25), self.OnPanKnobTurned)
-            .SetHandler(60, self.OnNavigationKnobTurned)
-        )
+        # MIDI ids of the button (command), knob and slider events.
+        command = 144
+        knob = 176
+        slider = 224
+        self._dispatcher = (
+            CompiledMidiEventDispatcher()
+            .SetHandler(command, 91, self.OnTransportsBack)
+            .SetHandler(command, 92, self.OnTransportsForward)
+            .SetHandler(command, 93, self.OnTransportsStop)
+            .SetHandler(command, 94, self.OnTransportsPausePlay)
+            .SetHandler(command, 95, self.OnTransportsRecord)
+            .SetHandler(command, 86, self.OnTransportsLoop)
+
+            .SetHandler(command, 80, self.OnGlobalSave)
+            .SetHandler(command, 87, self.OnGlobalIn, ignore_release=True)
+            .SetHandler(command, 88, self.OnGlobalOut, ignore_release=True)
+            .SetHandler(command, 89, self.OnGlobalMetro, ignore_release=True)
+            .SetHandler(command, 81, self.OnGlobalUndo)
+
+            .SetHandlerForKeys(command, range(8, 16), self.OnTrackSolo, ignore_release=True)
+            .SetHandlerForKeys(command, range(16, 24), self.OnTrackMute, ignore_release=True)
+            .SetHandlerForKeys(command, range(0, 8), self.OnTrackRecord)
+
+            .SetHandler(command, 74, self.OnTrackRead, ignore_release=True)
+            .SetHandler(command, 75, self.OnTrackWrite, ignore_release=True)
+
+            .SetHandler(command, 98, self.OnNavigationLeft)
+            .SetHandler(command, 99, self.OnNavigationRight)
+            .SetHandler(command, 84, self.OnNavigationKnobPressed, ignore_release=True)
+
+            .SetHandler(command, 49, self.OnBankNext)
+            .SetHandler(command, 48, self.OnBankPrev)
+            .SetHandler(command, 47, self.OnLivePart1, ignore_release=True)
+            .SetHandler(command, 46, self.OnLivePart2, ignore_release=True)
+
+            .SetHandlerForKeys(command, range(24, 32), self.OnBankSelect, ignore_release=True)
+            .SetHandlerForKeys(command, range(104, 112), self.OnStartOrEndSliderEvent)
+
+            .SetHandlerForKeys(knob, range(16, 25), self.OnPanKnobTurned)
+            .SetHandler(knob, 60, self.OnNavigationKnobTurned)
+
+            .SetHandlerForAllControls(slider, self.OnSliderEvent))   # Sliders 1-9
 
         def get_volume_line(): return '    [%d%%]' % int(channels.getChannelVolume(channels.selectedChannel()) * 100)
         def get_panning_line(): return '    [%d%%]' % int(channels.getChannelPan(channels.selectedChannel()) * 100)
@@ -291,7 +283,7 @@ class ArturiaMidiProcessor:
         self._display_hint('Unassigned', 'Knob press')
 
     def _request_plugin_window_focus(self):
-        current_time_ms = ArturiaDisplay.time_ms()
+        current_time_ms = self._controller.display().time_ms()
         # Require explicit window focus if last request to focus was more than a second ago.
         if current_time_ms > self._update_focus_time_ms + 1000:
             # This call is expensive so try to use sparingly.
@@ -369,13 +361,7 @@ class ArturiaMidiProcessor:
         self._recolor_mixer_track(prev_track)
 
     def ProcessEvent(self, event):
-        return self._midi_id_dispatcher.Dispatch(event)
-
-    def OnCommandEvent(self, event):
-        self._midi_command_dispatcher.Dispatch(event)
-
-    def OnKnobEvent(self, event):
-        self._knob_dispatcher.Dispatch(event)
+        return self._dispatcher.Dispatch(event)
 
     def OnSliderEvent(self, event):
         slider_index = event.status - event.midiId
@@ -386,7 +372,8 @@ class ArturiaMidiProcessor:
             if slider_value >= 126:
                 slider_value = 127
 
-        debug.log('OnSliderEvent', 'Slider %d = %d' % (slider_index, slider_value), event=event)
+        if debug.ENABLED:
+            debug.log('OnSliderEvent', 'Slider %d = %d', slider_index, slider_value, event=event)
         self._controller.encoders().ProcessSliderInput(event, slider_index, slider_value)
 
     @staticmethod
@@ -404,7 +391,8 @@ class ArturiaMidiProcessor:
 
     def OnNavigationKnobTurned(self, event):
         delta = self._get_knob_delta(event)
-        debug.log('OnNavigationKnob', 'Delta = %d' % delta, event=event)
+        if debug.ENABLED:
+            debug.log('OnNavigationKnob', 'Delta = %d', delta, event=event)
         if self._button_mode == arturia_macros.SAVE_BUTTON:
             self._change_playlist_track(delta)
         elif self._button_mode or self._locked_mode:
@@ -614,7 +602,8 @@ class ArturiaMidiProcessor:
     def _detect_long_press(self, event, short_fn, long_fn, duration_ms=450):
         control_id = event.controlNum
         if self._is_pressed(event):
-            task = self._controller.scheduler().ScheduleTask(lambda: long_fn(event), delay=duration_ms)
+            task = self._controller.scheduler().ScheduleTask(lambda: long_fn(event), delay=duration_ms,
+                                                             label='long press')
             self._long_press_tasks[control_id] = task
         else:
             # Release event. Attempt to cancel the scheduled long press task.
@@ -855,9 +844,9 @@ class ArturiaMidiProcessor:
 
     def OnBankSelect(self, event):
         bank_index = event.controlNum - 24
-        debug.log('OnBankSelect', 'Selected bank index=%d' % bank_index, event=event)
+        debug.log('OnBankSelect', 'Selected bank index=%d', bank_index, event=event)
         if self._button_mode or self._locked_mode:
-            debug.log('OnBankSelect', 'Dispatching macro. Mod=%d, index=%d' % (self._button_mode, bank_index),
+            debug.log('OnBankSelect', 'Dispatching macro. Mod=%d, index=%d', self._button_mode, bank_index,
                       event=event)
             channel_index = self._controller.encoders().GetBankChannelIndex(bank_index)
             self._macros.on_macro_actions(self._button_mode | self._locked_mode, bank_index, channel_index)
@@ -0,0 +1,188 @@
+""" Replays callback traces recorded with debug.CAPTURE_PATH_PREFIX against in-process stand-ins of the FL Studio API.
+
+This runs outside of FL Studio, from the script folder:
+
+    python arturia_replay.py --daw keylab_daw.trace --midi keylab_midi.trace
+
+Both device scripts are loaded side by side, each with its own copy of the script modules as in FL Studio, and the
+recorded callbacks are made into them in timestamp order on a virtual clock. Messages the scripts dispatch to each other
+are delivered live, so the recorded inter-script messages are skipped when both scripts are replayed. At the end, the
+per-callback latency percentiles, the FL Studio API call counts and the SysEx output are printed.
+
+The stand-ins keep just enough state (selected channel, channel names and colors, transport, ...) for the scripts to
+run; calls to anything else are counted and return 0.
+"""
+import argparse
+import importlib
+import importlib.util
+import os
+import sys
+import time
+
+import arturia_capture
+
+from arturia_standins import FLState, StandInEvent, StandInModule, make_fl_modules
+
+_REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Script files and the name each one's trace is replayed under.
+_SCRIPTS = (
+    ('daw', 'device_arturia_keylab_mkii.py'),
+    ('midi', 'device_arturia_keylab_mkii_midi.py'),
+)
+
+
+class _ScriptInstance:
+    """ A device script loaded with its own copy of the script modules and its own device module stand-in. """
+    def __init__(self, name, file_name, replayer):
+        self.name = name
+        self.peer = None
+        self.num_sysex_messages = 0
+        self.num_sysex_bytes = 0
+        self.num_dispatches = 0
+        self._replayer = replayer
+        self.device = StandInModule('device', {
+            'getName': lambda: replayer.device_name,
+            'midiOutSysex': self._midi_out_sysex,
+            'dispatch': self._dispatch,
+            'dispatchReceiverCount': lambda: 1 if self.peer is not None else 0,
+        }, replayer.call_counts)
+        self.module = self._load(file_name)
+
+    def _load(self, file_name):
+        # Drop the script modules loaded for the other script so that this one gets its own copies.
+        for module_name, module in list(sys.modules.items()):
+            if os.path.dirname(os.path.abspath(getattr(module, '__file__', None) or '/')) == _REPO_DIR:
+                if module is not sys.modules.get('__main__'):
+                    del sys.modules[module_name]
+        sys.modules['device'] = self.device
+        clock = importlib.import_module('arturia_clock')
+        clock.SystemClock.time_ms = staticmethod(self._replayer.time_ms)
+        clock.SystemClock.sleep = staticmethod(lambda seconds: None)
+        spec = importlib.util.spec_from_file_location('replay_' + self.name, os.path.join(_REPO_DIR, file_name))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    def _midi_out_sysex(self, message):
+        self.num_sysex_messages += 1
+        self.num_sysex_bytes += len(message)
+
+    def _dispatch(self, receiver, message):
+        self.num_dispatches += 1
+        if self.peer is not None:
+            self.peer.module.OnMidiMsg(StandInEvent(message & 0xFF, (message >> 8) & 0xFF, (message >> 16) & 0xFF))
+
+    def Call(self, kind, args):
+        if kind == arturia_capture.KIND_MIDI_MSG:
+            self.module.OnMidiMsg(StandInEvent(*args))
+        elif kind == arturia_capture.KIND_IDLE:
+            self.module.OnIdle()
+        elif kind == arturia_capture.KIND_REFRESH:
+            self.module.OnRefresh(*args)
+        elif kind == arturia_capture.KIND_BEAT and hasattr(self.module, 'OnUpdateBeatIndicator'):
+            self.module.OnUpdateBeatIndicator(*args)
+
+
+class Replayer:
+    """ Replays the callback traces of the device scripts and collects latency, API call and SysEx statistics. """
+    def __init__(self, traces, device_name='Arturia KeyLab mkII 61', state=None):
+        """ Create a replayer, loading the scripts that have a trace.
+
+        :param traces: mapping of script name ('daw' or 'midi') -> decoded trace (see arturia_capture.read_trace).
+        :param device_name: name reported by device.getName, which selects the keyboard model.
+        :param state: FLState for the API stand-ins.
+        """
+        self.device_name = device_name
+        self.state = state if state is not None else FLState()
+        # Mapping of 'module.function' -> number of calls.
+        self.call_counts = {}
+        # Mapping of (script name, callback name) -> list of durations in microseconds.
+        self.latencies_us = {}
+        self._traces = traces
+        self._time_ms = 0.0
+        sys.modules.update(make_fl_modules(self.state, self.call_counts))
+        self.scripts = {}
+        for name, file_name in _SCRIPTS:
+            if name in traces:
+                self.scripts[name] = _ScriptInstance(name, file_name, self)
+        if len(self.scripts) == 2:
+            self.scripts['daw'].peer = self.scripts['midi']
+            self.scripts['midi'].peer = self.scripts['daw']
+
+    def time_ms(self):
+        return self._time_ms
+
+    def _timed_call(self, script, callback_name, fn, *args):
+        start = time.perf_counter()
+        fn(*args)
+        elapsed_us = (time.perf_counter() - start) * 1e6
+        self.latencies_us.setdefault((script.name, callback_name), []).append(elapsed_us)
+
+    def Run(self):
+        """ Make the recorded callbacks into the scripts, in timestamp order. """
+        records = []
+        for name, trace in self._traces.items():
+            for time_us, kind, args in trace:
+                if (kind == arturia_capture.KIND_MIDI_MSG and args[0] < 0x80
+                        and self.scripts[name].peer is not None):
+                    # Inter-script message. The peer script sends it again during the replay.
+                    continue
+                records.append((time_us, name, kind, args))
+        records.sort(key=lambda record: record[0])
+        start_us = records[0][0] if records else 0
+        for script in self.scripts.values():
+            self._timed_call(script, 'OnInit', script.module.OnInit)
+        for time_us, name, kind, args in records:
+            self._time_ms = (time_us - start_us) / 1000.0
+            script = self.scripts[name]
+            self._timed_call(script, arturia_capture.KIND_NAMES[kind], script.Call, kind, args)
+        for script in self.scripts.values():
+            script.module.OnDeInit()
+
+    def Report(self):
+        """ Returns the statistics of the replay as printable text. """
+        lines = ['%-6s %-22s %8s %9s %9s %9s %9s' % ('script', 'callback', 'calls', 'p50 us', 'p90 us', 'p99 us',
+                                                      'max us')]
+        for (script_name, callback_name), durations in sorted(self.latencies_us.items()):
+            durations = sorted(durations)
+            lines.append('%-6s %-22s %8d %9.1f %9.1f %9.1f %9.1f' % (
+                script_name, callback_name, len(durations), _percentile(durations, 50), _percentile(durations, 90),
+                _percentile(durations, 99), durations[-1]))
+        lines.append('')
+        lines.append('FL Studio API calls:')
+        for key, count in sorted(self.call_counts.items(), key=lambda item: (-item[1], item[0])):
+            lines.append('  %-36s %8d' % (key, count))
+        lines.append('')
+        for script in self.scripts.values():
+            lines.append('%s: sysex out: %d messages, %d bytes. dispatches to the other script: %d' % (
+                script.name, script.num_sysex_messages, script.num_sysex_bytes, script.num_dispatches))
+        return '\n'.join(lines)
+
+
+def _percentile(sorted_values, percent):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100.0))
+    return sorted_values[index]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay callback traces of the Arturia Keylab scripts.')
+    parser.add_argument('--daw', help='trace of the DAW script (<prefix>_daw.trace)')
+    parser.add_argument('--midi', help='trace of the MIDI script (<prefix>_midi.trace)')
+    parser.add_argument('--device-name', default='Arturia KeyLab mkII 61',
+                        help='device name reported to the scripts, which selects the keyboard model')
+    args = parser.parse_args(argv)
+    traces = {}
+    for name, path in (('daw', args.daw), ('midi', args.midi)):
+        if path:
+            with open(path, 'rb') as f:
+                traces[name] = arturia_capture.read_trace(f.read())
+    if not traces:
+        parser.error('at least one of --daw and --midi is needed')
+    replayer = Replayer(traces, device_name=args.device_name)
+    replayer.Run()
+    print(replayer.Report())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,370 @@
 import _heapq
-import _random
-import time
+
+import debug
+from arturia_clock import SYSTEM_CLOCK
+
+# Minimum number of cancelled entries that must accumulate in the heap before it is compacted.
+_COMPACT_MIN_CANCELLED = 64
+
+# Number of bits of the tick consumed by each level of the timer wheel. Level 0 has one slot per millisecond and spans
+# 256 ms, level 1 spans ~16 s, level 2 spans ~17 min and level 3 spans ~18 hours. Tasks further out are parked in the
+# last slot of level 3 and re-inserted as the wheel turns.
+_WHEEL_LEVEL_BITS = (8, 6, 6, 6)
+
+# Priority lanes for scheduled tasks. When tasks from several lanes are due, lower numbered lanes run first.
+# Timing critical work such as note playback.
+PRIORITY_REALTIME = 0
+# Default lane for tasks that react to user input.
+PRIORITY_NORMAL = 1
+# Cosmetic work such as display refreshes and LED blinks that may be deferred, or dropped, when Idle runs out of time.
+PRIORITY_BEST_EFFORT = 2
+_NUM_PRIORITIES = 3
+
+# Upper bounds in milliseconds of the lateness histogram buckets. The last bucket collects everything later.
+LATENESS_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100)
+
+# Metrics of every scheduler that has metrics enabled, in creation order.
+_ALL_METRICS = []
+
+
+class ScheduledTask:
+    """ Handle returned by Scheduler.ScheduleTask that can be passed to Scheduler.CancelTask.
+
+    Cancelling a task only clears the task function so that the queue entry becomes a tombstone. Tombstones are
+    discarded when they reach the front of the queue or when the queue is compacted.
+
+    The time of a keyed task may be pushed back while it is queued. Queues therefore only guarantee that a task is not
+    popped before the time it was pushed with, and the Scheduler re-queues tasks popped before their current time.
+    """
+    __slots__ = ('time_ms', 'task', 'period_ms', 'key', 'label', 'priority')
+
+    def __init__(self, time_ms, task, period_ms=None, key=None, label=None, priority=PRIORITY_NORMAL):
+        # Timestamp in milliseconds at which the task should run.
+        self.time_ms = time_ms
+        # Function to call or None once the task has been executed or cancelled.
+        self.task = task
+        # Number of milliseconds between runs of a repeating task or None if the task only runs once.
+        self.period_ms = period_ms
+        # Key that the task was scheduled under or None.
+        self.key = key
+        # Name that metrics for this task are grouped under or None to use the name of the task function.
+        self.label = label
+        # Priority lane the task is queued in.
+        self.priority = priority
+
+    def IsPending(self):
+        """ Returns True if the task has neither been executed nor cancelled. """
+        return self.task is not None
+
+
+class HeapTaskQueue:
+    """ Binary heap of scheduled tasks. O(log n) insert and expire, exact ordering by time then insertion. """
+    def __init__(self, time_ms=0):
+        # time_ms is unused. It is accepted so that all task queues can be constructed the same way.
+        # Priority queue of (time_ms, sequence number, ScheduledTask) tuples. The sequence number is unique so ties on
+        # time_ms are broken in insertion order and the ScheduledTask itself is never compared.
+        self._tasks_pq = []
+        self._sequence = 0
+        # Number of cancelled entries still sitting in the queue.
+        self._num_cancelled = 0
+
+    def __len__(self):
+        return len(self._tasks_pq) - self._num_cancelled
+
+    def Push(self, entry):
+        self._sequence += 1
+        _heapq.heappush(self._tasks_pq, (entry.time_ms, self._sequence, entry))
+
+    def NotifyCancelled(self):
+        self._num_cancelled += 1
+        if (self._num_cancelled >= _COMPACT_MIN_CANCELLED
+                and 2 * self._num_cancelled >= len(self._tasks_pq)):
+            # Drop all cancelled entries and restore the heap invariant.
+            self._tasks_pq = [item for item in self._tasks_pq if item[2].task is not None]
+            _heapq.heapify(self._tasks_pq)
+            self._num_cancelled = 0
+
+    def PopDue(self, time_ms):
+        """ Remove and return the earliest pending task due at or before time_ms, or None if there is none. """
+        tasks_pq = self._tasks_pq
+        while tasks_pq:
+            time_due, _, entry = tasks_pq[0]
+            if entry.task is None:
+                # Discard cancelled entry.
+                _heapq.heappop(tasks_pq)
+                self._num_cancelled -= 1
+                continue
+            if time_due > time_ms:
+                # Entry delay condition not met. Wait until next refresh cycle.
+                return None
+            _heapq.heappop(tasks_pq)
+            return entry
+        return None
+
+    def NextTimeMs(self):
+        """ Returns the timestamp of the earliest pending task or None if there are no pending tasks. """
+        tasks_pq = self._tasks_pq
+        while tasks_pq and tasks_pq[0][2].task is None:
+            _heapq.heappop(tasks_pq)
+            self._num_cancelled -= 1
+        return tasks_pq[0][0] if tasks_pq else None
+
+    def CountDue(self, time_ms):
+        """ Returns the number of pending tasks due at or before time_ms. """
+        tasks_pq = self._tasks_pq
+        count = 0
+        # Walk the heap from the root, pruning subtrees whose root is not yet due.
+        stack = [0] if tasks_pq else []
+        while stack:
+            i = stack.pop()
+            time_due, _, entry = tasks_pq[i]
+            if time_due > time_ms:
+                continue
+            if entry.task is not None and entry.time_ms <= time_ms:
+                count += 1
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(tasks_pq):
+                    stack.append(child)
+        return count
+
+
+class TimerWheelTaskQueue:
+    """ Hierarchical timer wheel of scheduled tasks bucketed at 1 ms. O(1) insert and expire.
+
+    Tasks never run early, but may run up to 1 ms late, and tasks falling into the same millisecond are not guaranteed
+    to run in insertion order. Prefer this over HeapTaskQueue when thousands of tasks are pending at once.
+    """
+    def __init__(self, time_ms=0):
+        # Last tick (millisecond) that has been moved into the ready list.
+        self._current_tick = int(time_ms)
+        # One list of slots per level. Each slot holds the ScheduledTasks expiring within that slot's span.
+        self._levels = [[[] for _ in range(1 << bits)] for bits in _WHEEL_LEVEL_BITS]
+        self._shifts = []
+        shift = 0
+        for bits in _WHEEL_LEVEL_BITS:
+            self._shifts.append(shift)
+            shift += bits
+        self._max_delta = (1 << shift) - 1
+        self._level0_size = len(self._levels[0])
+        self._level0_mask = self._level0_size - 1
+        # Tasks that have expired and are waiting to be popped, consumed from _ready_pos onwards.
+        self._ready = []
+        self._ready_pos = 0
+        # Number of entries held by the wheel (including cancelled entries), and how many of those are cancelled.
+        self._num_entries = 0
+        self._num_cancelled = 0
+
+    def __len__(self):
+        return self._num_entries - self._num_cancelled
+
+    @staticmethod
+    def _tick_of(entry):
+        # Round up so that a task is never considered due before its time.
+        time_ms = entry.time_ms
+        tick = int(time_ms)
+        return tick + 1 if tick < time_ms else tick
+
+    def Push(self, entry):
+        self._num_entries += 1
+        time_ms = entry.time_ms
+        tick = int(time_ms)
+        if tick < time_ms:
+            tick += 1
+        delta = tick - self._current_tick
+        if delta <= 0:
+            self._ready.append(entry)
+        elif delta < self._level0_size:
+            # Fast path for the common case of tasks due within the next 256 ms.
+            self._levels[0][tick & self._level0_mask].append(entry)
+        else:
+            self._insert(entry, tick)
+
+    def _insert(self, entry, tick):
+        delta = tick - self._current_tick
+        if delta <= 0:
+            self._ready.append(entry)
+            return
+        if delta > self._max_delta:
+            tick = self._current_tick + self._max_delta
+            delta = self._max_delta
+        for level, shift in enumerate(self._shifts):
+            slots = self._levels[level]
+            if delta < (len(slots) << shift):
+                slots[(tick >> shift) & (len(slots) - 1)].append(entry)
+                return
+
+    def NotifyCancelled(self):
+        self._num_cancelled += 1
+
+    def _cascade(self, level):
+        # Re-insert all entries of the level's current slot into the lower levels, dropping cancelled entries.
+        shift = self._shifts[level]
+        slots = self._levels[level]
+        index = (self._current_tick >> shift) & (len(slots) - 1)
+        entries = slots[index]
+        if not entries:
+            return index
+        slots[index] = []
+        level0 = self._levels[0]
+        for entry in entries:
+            if entry.task is None:
+                self._num_entries -= 1
+                self._num_cancelled -= 1
+                continue
+            tick = self._tick_of(entry)
+            if 0 < tick - self._current_tick < self._level0_size:
+                level0[tick & self._level0_mask].append(entry)
+            else:
+                self._insert(entry, tick)
+        return index
+
+    def _advance(self, tick):
+        if self._num_entries == len(self._ready) - self._ready_pos:
+            # Nothing in the wheel itself, so there is nothing to cascade while catching up.
+            self._current_tick = max(self._current_tick, tick)
+            return
+        level0 = self._levels[0]
+        mask0 = self._level0_mask
+        current_tick = self._current_tick
+        while current_tick < tick:
+            current_tick += 1
+            index = current_tick & mask0
+            if index == 0:
+                self._current_tick = current_tick
+                level = 1
+                while level < len(self._levels) and self._cascade(level) == 0:
+                    level += 1
+            if level0[index]:
+                self._ready.extend(level0[index])
+                level0[index] = []
+        self._current_tick = current_tick
+
+    def NextTimeMs(self):
+        """ Returns the tick at which the earliest pending task is due or None if there are no pending tasks.
+
+        NOTE: This scans every slot of the wheel and is meant for simulations rather than the Idle loop.
+        """
+        for i in range(self._ready_pos, len(self._ready)):
+            if self._ready[i].task is not None:
+                return self._current_tick
+        next_tick = None
+        for slots in self._levels:
+            for entries in slots:
+                for entry in entries:
+                    if entry.task is not None:
+                        tick = self._tick_of(entry)
+                        if next_tick is None or tick < next_tick:
+                            next_tick = tick
+        return next_tick
+
+    def CountDue(self, time_ms):
+        """ Returns the number of pending tasks due at or before time_ms. """
+        self._advance(int(time_ms))
+        count = 0
+        for i in range(self._ready_pos, len(self._ready)):
+            entry = self._ready[i]
+            if entry.task is not None and entry.time_ms <= time_ms:
+                count += 1
+        return count
+
+    def PopDue(self, time_ms):
+        """ Remove and return a pending task due at or before time_ms, or None if there is none. """
+        if time_ms >= self._current_tick + 1:
+            self._advance(int(time_ms))
+        ready = self._ready
+        while self._ready_pos < len(ready):
+            entry = ready[self._ready_pos]
+            self._ready_pos += 1
+            self._num_entries -= 1
+            if entry.task is None:
+                self._num_cancelled -= 1
+                continue
+            return entry
+        # Ready list fully consumed.
+        ready.clear()
+        self._ready_pos = 0
+        return None
+
+
+class SchedulerMetrics:
+    """ Collects queue depth, lateness and execution time statistics for a Scheduler.
+
+    Lateness is the time a task actually ran minus the time it was scheduled for. Statistics are grouped by task label.
+    """
+    def __init__(self, name):
+        self._name = name
+        self.Reset()
+
+    def Reset(self):
+        # Number of Idle calls observed, along with the sum and maximum of the queue depth seen at each call.
+        self._num_idle_calls = 0
+        self._depth_total = 0
+        self._depth_max = 0
+        self._depth_last = 0
+        # Number of best-effort task runs dropped because Idle ran out of time.
+        self._num_dropped = 0
+        # Mapping of label -> [count, total execution ms, max execution ms, max lateness ms, bucket counts...]
+        self._by_label = {}
+
+    def RecordIdle(self, depth):
+        self._num_idle_calls += 1
+        self._depth_total += depth
+        self._depth_last = depth
+        if depth > self._depth_max:
+            self._depth_max = depth
+
+    def RecordDropped(self):
+        self._num_dropped += 1
+
+    def RecordTask(self, entry, task, lateness_ms, execution_ms):
+        label = entry.label
+        if label is None:
+            label = getattr(task, '__qualname__', None) or type(task).__name__
+        stats = self._by_label.get(label)
+        if stats is None:
+            stats = [0, 0.0, 0.0, 0.0] + [0] * (len(LATENESS_BUCKETS_MS) + 1)
+            self._by_label[label] = stats
+        stats[0] += 1
+        stats[1] += execution_ms
+        if execution_ms > stats[2]:
+            stats[2] = execution_ms
+        if lateness_ms > stats[3]:
+            stats[3] = lateness_ms
+        bucket = 0
+        while bucket < len(LATENESS_BUCKETS_MS) and lateness_ms >= LATENESS_BUCKETS_MS[bucket]:
+            bucket += 1
+        stats[4 + bucket] += 1
+
+    def LatenessHistogram(self, label):
+        """ Returns the number of runs of tasks with the label that fell into each bucket of LATENESS_BUCKETS_MS. """
+        stats = self._by_label.get(label)
+        return list(stats[4:]) if stats else [0] * (len(LATENESS_BUCKETS_MS) + 1)
+
+    def Format(self):
+        """ Returns the metrics as a list of printable lines. """
+        avg_depth = self._depth_total / self._num_idle_calls if self._num_idle_calls else 0
+        lines = ['[%s] idle calls: %d, queue depth: last=%d avg=%.1f max=%d, dropped: %d' % (
+            self._name, self._num_idle_calls, self._depth_last, avg_depth, self._depth_max, self._num_dropped)]
+        headers = ['<%dms' % b for b in LATENESS_BUCKETS_MS] + ['>=%dms' % LATENESS_BUCKETS_MS[-1]]
+        lines.append('%-40s %7s %9s %8s %8s  %s' % (
+            'label', 'runs', 'exec ms', 'max ms', 'late max', ' '.join('%6s' % h for h in headers)))
+        for label, stats in sorted(self._by_label.items(), key=lambda item: -item[1][1]):
+            lines.append('%-40s %7d %9.2f %8.2f %8.2f  %s' % (
+                label[-40:], stats[0], stats[1], stats[2], stats[3], ' '.join('%6d' % c for c in stats[4:])))
+        return lines
+
+    def Dump(self):
+        """ Print the metrics to the script output. """
+        for line in self.Format():
+            print(line)
+
+
+def DumpAllMetrics():
+    """ Print the metrics of every scheduler that has metrics enabled to the script output. """
+    if not _ALL_METRICS:
+        print('No scheduler metrics collected. Set debug.SCHEDULER_METRICS = True to enable them.')
+    for metrics in _ALL_METRICS:
+        metrics.Dump()
 
 
 class Scheduler:
@@ -11,40 +375,231 @@ class Scheduler:
     needing to worry about additional boiler-plate code. The only requirement is that this class's Refresh method
     must be hooked up to midiscript's the OnIdle event.
     """
-    def __init__(self):
-        self._tasks_pq = []
-        self._random = _random.Random()
-
-    def ScheduleTask(self, task, delay=0):
-        time_ms = time.monotonic() * 1000
-        # Assumption is that there are no ties. Otherwise, comparing last element of the tuple will lead to crashes.
-        entry = (time_ms + delay,
-                 len(self._tasks_pq),
-                 # Add some random numbers so that one of these will break the tie
-                 int(self._random.random() * 16777215),
-                 int(self._random.random() * 16777215),
-                 int(self._random.random() * 16777215),
-                 int(self._random.random() * 16777215),
-                 int(self._random.random() * 16777215),
-                 task)
-        _heapq.heappush(self._tasks_pq, entry)
+    def __init__(self, queue_class=HeapTaskQueue, idle_budget_us=0, clock=None, metrics=None, drop_best_effort=False):
+        """ Create a scheduler.
+
+        :param queue_class: class used to hold pending tasks, either HeapTaskQueue or TimerWheelTaskQueue.
+        :param idle_budget_us: default number of microseconds each call to Idle may spend running tasks before the
+            remaining due tasks are deferred to the next call. 0 means no limit.
+        :param clock: clock used to timestamp tasks (see arturia_clock). Defaults to the system clock.
+        :param metrics: True to collect SchedulerMetrics. Defaults to the value of debug.SCHEDULER_METRICS.
+        :param drop_best_effort: if True, due PRIORITY_BEST_EFFORT tasks are dropped rather than deferred once Idle runs
+            out of time. Dropped one-shot tasks are cancelled and dropped repeating tasks skip to their next period.
+        """
+        if clock is None:
+            clock = SYSTEM_CLOCK
+        self._clock = clock
+        # One queue per priority lane, indexed by priority.
+        self._queues = [queue_class(clock.time_ms()) for _ in range(_NUM_PRIORITIES)]
+        self._idle_budget_us = idle_budget_us
+        self._drop_best_effort = drop_best_effort
+        # Number of milliseconds each task run by the last Idle call ran past its scheduled time.
+        self._idle_lateness_ms = []
+        # Number of due tasks the last Idle call left for the next call.
+        self._idle_num_deferred = 0
+        # Number of due best-effort tasks the last Idle call dropped.
+        self._idle_num_dropped = 0
+        # Mapping of key -> pending ScheduledTask for tasks scheduled with a key.
+        self._keyed_tasks = {}
+        self._metrics = None
+        if metrics is None:
+            metrics = debug.SCHEDULER_METRICS
+        self.EnableMetrics(metrics)
+
+    def EnableMetrics(self, enabled=True):
+        """ Start or stop collecting metrics. Collected metrics are kept when stopped. """
+        if enabled and self._metrics is None:
+            self._metrics = SchedulerMetrics('Scheduler %d' % (len(_ALL_METRICS) + 1))
+            _ALL_METRICS.append(self._metrics)
+        elif not enabled and self._metrics is not None:
+            _ALL_METRICS.remove(self._metrics)
+            self._metrics = None
+        return self
+
+    def metrics(self):
+        """ Returns the SchedulerMetrics being collected or None if metrics are disabled. """
+        return self._metrics
+
+    def ScheduleTask(self, task, delay=0, key=None, label=None, priority=PRIORITY_NORMAL):
+        """ Schedule a task to run on the Idle loop after at least delay milliseconds.
+
+        :param task: function taking no arguments to call.
+        :param delay: number of milliseconds to wait before calling the task.
+        :param key: optional hashable key. If a task is already pending under the same key, that task is replaced by
+            this one (both its function and its time) instead of queueing another task, so a burst of N requests under
+            one key costs a single queued task.
+        :param label: name to group metrics for the task under. Defaults to the name of the task function.
+        :param priority: lane to queue the task in (PRIORITY_REALTIME, PRIORITY_NORMAL or PRIORITY_BEST_EFFORT).
+        :return: a ScheduledTask handle that can be used to cancel the task.
+        """
+        time_ms = self._clock.time_ms() + delay
+        if key is not None:
+            entry = self._keyed_tasks.get(key)
+            if entry is not None:
+                if time_ms >= entry.time_ms and priority == entry.priority:
+                    # Update in place. Idle re-queues the entry if it reaches the front before its new time.
+                    entry.time_ms = time_ms
+                    entry.task = task
+                    entry.label = label
+                    return entry
+                # Moving a task earlier or to another lane needs a new position in the queues.
+                self.CancelTask(entry)
+        entry = ScheduledTask(time_ms, task, key=key, label=label, priority=priority)
+        self._queues[priority].Push(entry)
+        if key is not None:
+            self._keyed_tasks[key] = entry
+        return entry
+
+    def ScheduleRepeating(self, task, period_ms, delay=None, label=None, priority=PRIORITY_NORMAL):
+        """ Schedule a task to run on the Idle loop every period_ms milliseconds until cancelled.
+
+        Runs are anchored to the time of the first run so that the period does not drift when Idle is late. If Idle
+        falls behind by more than a period, the missed runs are skipped rather than run back to back.
+
+        :param task: function taking no arguments to call.
+        :param period_ms: number of milliseconds between runs. Must be positive.
+        :param delay: number of milliseconds to wait before the first run. Defaults to period_ms.
+        :param label: name to group metrics for the task under. Defaults to the name of the task function.
+        :param priority: lane to queue the task in (PRIORITY_REALTIME, PRIORITY_NORMAL or PRIORITY_BEST_EFFORT).
+        :return: a single ScheduledTask handle that cancels all future runs when passed to CancelTask.
+        """
+        if period_ms <= 0:
+            raise ValueError('period_ms must be positive: %s' % period_ms)
+        if delay is None:
+            delay = period_ms
+        entry = ScheduledTask(self._clock.time_ms() + delay, task, period_ms=period_ms, label=label,
+                              priority=priority)
+        self._queues[priority].Push(entry)
         return entry
 
     def CancelTask(self, entry):
-        try:
-            self._tasks_pq.remove(entry)
-            return True
-        except ValueError:
+        """ Cancel a previously scheduled task in O(1).
+
+        :param entry: the handle returned by ScheduleTask.
+        :return: True if the task was pending and is now cancelled. False if it already ran or was cancelled.
+        """
+        if entry is None or entry.task is None:
             # Entry was already removed and executed.
             return False
+        entry.task = None
+        if entry.key is not None:
+            del self._keyed_tasks[entry.key]
+        self._queues[entry.priority].NotifyCancelled()
+        return True
 
-    def Idle(self):
-        time_ms = time.monotonic() * 1000
-        while self._tasks_pq:
-            entry = _heapq.heappop(self._tasks_pq)
-            if entry[0] > time_ms:
-                # Entry delay condition not met. Put back on queue and wait until next refresh cycle.
-                _heapq.heappush(self._tasks_pq, entry)
-                return
-            task = entry[-1]
+    def clock(self):
+        return self._clock
+
+    def NextTaskTimeMs(self):
+        """ Returns the timestamp in milliseconds at which the next pending task is due, or None if there is none. """
+        next_ms = None
+        for queue in self._queues:
+            time_ms = queue.NextTimeMs()
+            if time_ms is not None and (next_ms is None or time_ms < next_ms):
+                next_ms = time_ms
+        return next_ms
+
+    def NumPendingTasks(self):
+        """ Returns the number of tasks that are waiting to be run. """
+        return sum(len(queue) for queue in self._queues)
+
+    def LastIdleLateness(self):
+        """ Returns how many milliseconds late each task run by the last Idle call was, in the order they ran. """
+        return self._idle_lateness_ms
+
+    def LastIdleNumDeferred(self):
+        """ Returns the number of due tasks that the last Idle call deferred because its time budget ran out. """
+        return self._idle_num_deferred
+
+    def LastIdleNumDropped(self):
+        """ Returns the number of due best-effort tasks that the last Idle call dropped because its time ran out. """
+        return self._idle_num_dropped
+
+    def _reschedule(self, entry, now_ms):
+        # Re-queue a repeating task for its next run, skipping any runs that are already in the past. This happens
+        # before the task runs so that the task is able to cancel itself.
+        period_ms = entry.period_ms
+        next_ms = entry.time_ms + period_ms
+        if next_ms <= now_ms:
+            next_ms += period_ms * (int((now_ms - next_ms) / period_ms) + 1)
+        entry.time_ms = next_ms
+        self._queues[entry.priority].Push(entry)
+
+    def _pop_due(self, time_ms):
+        # Pop a due task from the highest priority lane that has one.
+        for queue in self._queues:
+            entry = queue.PopDue(time_ms)
+            if entry is not None:
+                return entry
+        return None
+
+    def _drop_due_best_effort(self, time_ms, now_ms):
+        # Drop every best-effort task due at or before time_ms and return how many were dropped.
+        queue = self._queues[PRIORITY_BEST_EFFORT]
+        num_dropped = 0
+        entry = queue.PopDue(time_ms)
+        while entry is not None:
+            if entry.time_ms > time_ms:
+                # Keyed task that was pushed back after it was queued.
+                queue.Push(entry)
+            else:
+                num_dropped += 1
+                if entry.period_ms is None:
+                    entry.task = None
+                    if entry.key is not None:
+                        del self._keyed_tasks[entry.key]
+                else:
+                    self._reschedule(entry, now_ms)
+                if self._metrics is not None:
+                    self._metrics.RecordDropped()
+            entry = queue.PopDue(time_ms)
+        return num_dropped
+
+    def Idle(self, budget_us=None):
+        """ Run the tasks that are due, highest priority lane first and earliest deadline first within a lane.
+
+        :param budget_us: number of microseconds that may be spent running tasks. Once exceeded, the remaining due
+            tasks are left for the next call. At least one due task always runs. Defaults to the scheduler's budget.
+        :return: the number of due tasks that were deferred.
+        """
+        if budget_us is None:
+            budget_us = self._idle_budget_us
+        start_ms = self._clock.time_ms()
+        deadline_ms = start_ms + budget_us / 1000.0 if budget_us else None
+        lateness = self._idle_lateness_ms
+        lateness.clear()
+        self._idle_num_deferred = 0
+        self._idle_num_dropped = 0
+        metrics = self._metrics
+        if metrics is not None:
+            metrics.RecordIdle(self.NumPendingTasks())
+        now_ms = start_ms
+        # Only tasks due when Idle was entered are run so that tasks rescheduling themselves cannot starve the loop.
+        entry = self._pop_due(start_ms)
+        while entry is not None:
+            if entry.time_ms > start_ms:
+                # Keyed task that was pushed back after it was queued.
+                self._queues[entry.priority].Push(entry)
+                entry = self._pop_due(start_ms)
+                continue
+            task = entry.task
+            lateness_ms = now_ms - entry.time_ms
+            lateness.append(lateness_ms)
+            if entry.period_ms is None:
+                entry.task = None
+                if entry.key is not None:
+                    del self._keyed_tasks[entry.key]
+            else:
+                self._reschedule(entry, now_ms)
+            task_start_ms = now_ms
             task()
+            now_ms = self._clock.time_ms()
+            if metrics is not None:
+                metrics.RecordTask(entry, task, lateness_ms, now_ms - task_start_ms)
+            if deadline_ms is not None and now_ms >= deadline_ms:
+                if self._drop_best_effort:
+                    self._idle_num_dropped = self._drop_due_best_effort(start_ms, now_ms)
+                self._idle_num_deferred = sum(queue.CountDue(start_ms) for queue in self._queues)
+                break
+            entry = self._pop_due(start_ms)
+        return self._idle_num_deferred
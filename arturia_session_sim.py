@@ -0,0 +1,134 @@
+""" Simulates a long session of the DAW script components on a virtual clock and checks that tasks run exactly on time.
+
+This runs outside of FL Studio, from the script folder:
+
+    python arturia_session_sim.py --minutes 10
+
+The session plays a recorded drum pad pattern on a loop, scrolls a two-line page that is too long for the display,
+refreshes the display every 100 ms and steps the metronome lights on every beat at 120 BPM. VirtualClock.RunFor jumps
+from one due task to the next, so minutes of the session replay in milliseconds. The script then checks that:
+  - every loop of the pattern started exactly on a multiple of the loop period,
+  - every note of the pattern played exactly at its recorded offset within the loop,
+  - no task ran late in any Idle call,
+  - the metronome got every beat.
+The script exits with an error on the first check that fails.
+"""
+import argparse
+import sys
+import time
+
+from arturia_standins import FLState, StandInModule, make_fl_modules
+
+# Recorded pattern as saved by the Recorder: (timestamp ms, channel, note, velocity) for each note.
+_PATTERN = [
+    0, 0, 60, 100,
+    250, 0, 62, 100,
+    500, 0, 64, 100,
+]
+_PATTERN_KEY = 36
+# Milliseconds between two beats at the tempo reported by the stand-in mixer module (120 BPM).
+_BEAT_MS = 500
+# A loop replays once the last note of the pattern has played and a beat has passed.
+_LOOP_PERIOD_MS = _PATTERN[-4] - _PATTERN[0] + _BEAT_MS
+_DISPLAY_REFRESH_MS = 100
+
+
+class _LatenessProbe:
+    """ Wraps a Scheduler for VirtualClock.RunFor and keeps the largest lateness of the tasks run by any Idle call. """
+    def __init__(self, scheduler):
+        self._scheduler = scheduler
+        self.max_lateness_ms = 0
+
+    def NextTaskTimeMs(self):
+        return self._scheduler.NextTaskTimeMs()
+
+    def Idle(self):
+        self._scheduler.Idle()
+        lateness = self._scheduler.LastIdleLateness()
+        if lateness:
+            self.max_lateness_ms = max(self.max_lateness_ms, max(lateness))
+
+
+def _install_fl_modules(notes, sysex, clock):
+    # Install the FL Studio API stand-ins, recording the notes played and the SysEx sent.
+    modules = make_fl_modules(FLState(), {})
+    modules['channels'].midiNoteOn = lambda channel, note, velocity: notes.append((clock.time_ms(), note))
+    modules['device'] = StandInModule('device', {
+        'getName': lambda: 'Arturia KeyLab mkII 61',
+        'midiOutSysex': sysex.append,
+        'dispatchReceiverCount': lambda: 0,
+    }, {})
+    sys.modules.update(modules)
+
+
+def run(minutes):
+    """ Simulate a session and check its timing. Raises AssertionError if a check fails.
+
+    :return: (number of notes played, number of beats, number of SysEx messages sent, wall time in seconds).
+    """
+    from arturia_clock import VirtualClock
+    clock = VirtualClock(start_ms=0)
+    notes = []
+    sysex = []
+    _install_fl_modules(notes, sysex, clock)
+
+    # Loaded once the stand-ins are installed, as they import the FL Studio modules.
+    from arturia import ArturiaController
+    from arturia_recorder import Recorder
+    from arturia_savedata import SaveData
+    from arturia_scheduler import Scheduler
+
+    wall_start = time.perf_counter()
+    controller = ArturiaController(clock=clock)
+    controller.Sync(0xFFFF)
+    pages = controller.paged_display()
+    pages.SetPageLines('main', line1='A channel name too long for the display',
+                       line2='And a pattern name that scrolls as well')
+    pages.SetActivePage('main')
+
+    # The recorder lives in the MIDI script, which has its own scheduler on the same clock.
+    midi_scheduler = Scheduler(clock=clock)
+    savedata = SaveData()
+    savedata.Put(str(_PATTERN_KEY), list(_PATTERN))
+    recorder = Recorder(midi_scheduler, savedata)
+    recorder.Play(_PATTERN_KEY, loop=True)
+
+    beats = []
+
+    def beat():
+        beats.append(clock.time_ms())
+        controller.metronome().ProcessBeat(1 if len(beats) % 4 == 1 else 2)
+
+    controller.scheduler().ScheduleRepeating(beat, _BEAT_MS, delay=0)
+    controller.scheduler().ScheduleRepeating(controller.RefreshDisplay, _DISPLAY_REFRESH_MS)
+
+    duration_ms = int(minutes * 60 * 1000)
+    probes = [_LatenessProbe(midi_scheduler), _LatenessProbe(controller.scheduler())]
+    clock.RunFor(duration_ms, probes)
+    wall_s = time.perf_counter() - wall_start
+
+    num_loops = duration_ms // _LOOP_PERIOD_MS + 1
+    starts = [time_ms for time_ms, note in notes if note == _PATTERN[2]]
+    assert starts == [i * _LOOP_PERIOD_MS for i in range(num_loops)], 'loops did not start on multiples of %d ms' % (
+        _LOOP_PERIOD_MS)
+    offsets = [_PATTERN[i] - _PATTERN[0] for i in range(0, len(_PATTERN), 4)]
+    expected_notes = [(start + offset, _PATTERN[i * 4 + 2]) for start in starts for i, offset in enumerate(offsets)
+                      if start + offset <= duration_ms]
+    assert notes == expected_notes, 'notes did not play at their recorded offsets'
+    for probe in probes:
+        assert probe.max_lateness_ms == 0, 'a task ran %s ms late' % probe.max_lateness_ms
+    assert beats == [i * _BEAT_MS for i in range(duration_ms // _BEAT_MS + 1)], 'the metronome missed beats'
+    return len(notes), len(beats), len(sysex), wall_s
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate a session of the Arturia Keylab scripts on a virtual clock.')
+    parser.add_argument('--minutes', type=float, default=10, help='simulated length of the session')
+    args = parser.parse_args(argv)
+    num_notes, num_beats, num_sysex, wall_s = run(args.minutes)
+    print('Simulated %g minutes in %.0f ms: %d notes, %d beats, %d SysEx messages. All tasks ran on time.' % (
+        args.minutes, wall_s * 1000, num_notes, num_beats, num_sysex))
+
+
+if __name__ == '__main__':
+    main()
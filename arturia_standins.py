@@ -0,0 +1,217 @@
+""" Stand-ins of the FL Studio API modules, for running the scripts outside of FL Studio.
+
+Used by the offline tools (arturia_replay.py, arturia_session_sim.py, ...). The stand-ins keep just enough state
+(selected channel, channel names and colors, transport, ...) for the scripts to run; calls to anything else are counted
+and return 0.
+"""
+import colorsys
+import types
+
+# Constants of the FL Studio midi module used by the scripts. Constants not listed here get distinct made-up values.
+_MIDI_CONSTANTS = {
+    'HW_Dirty_LEDs': 256,
+    'widMixer': 0,
+    'widChannelRack': 1,
+    'widPlaylist': 2,
+    'widPianoRoll': 3,
+    'widBrowser': 4,
+    'FromMIDI_Max': 16384,
+}
+
+
+class FLState:
+    """ State behind the FL Studio API stand-ins. """
+    def __init__(self, num_channels=16, num_patterns=8, num_mixer_tracks=127, num_playlist_tracks=500):
+        self.channel_names = ['Channel %d' % (i + 1) for i in range(num_channels)]
+        self.channel_colors = [0x5A8CC8 + 0x0F0A05 * i for i in range(num_channels)]
+        self.channel_volumes = [0.78] * num_channels
+        self.channel_pans = [0.0] * num_channels
+        self.channel_pitches = [0.0] * num_channels
+        self.selected_channel = 0
+        self.pattern_names = ['Pattern %d' % (i + 1) for i in range(num_patterns)]
+        self.pattern_number = 1
+        self.mixer_track_names = ['Insert %d' % i for i in range(num_mixer_tracks)]
+        self.playlist_track_names = ['Track %d' % (i + 1) for i in range(num_playlist_tracks)]
+        self.playing = False
+        self.recording = False
+        self.song_pos = 0
+        self.loop_mode = 0
+        self.hint = ''
+
+
+class StandInModule(types.ModuleType):
+    """ Module whose functions count their calls. Functions without an implementation return 0. """
+    def __init__(self, name, functions, call_counts, constants=None):
+        super().__init__(name)
+        self._call_counts = call_counts
+        for attr, fn in functions.items():
+            setattr(self, attr, self._counted(attr, fn))
+        for attr, value in (constants or {}).items():
+            setattr(self, attr, value)
+
+    def _counted(self, attr, fn):
+        key = '%s.%s' % (self.__name__, attr)
+        call_counts = self._call_counts
+
+        def counted_fn(*args, **kwargs):
+            call_counts[key] = call_counts.get(key, 0) + 1
+            return fn(*args, **kwargs)
+        return counted_fn
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        fn = self._counted(attr, lambda *args, **kwargs: 0)
+        setattr(self, attr, fn)
+        return fn
+
+
+class _MidiConstants(types.ModuleType):
+    """ Stand-in for the FL Studio midi module, which only holds constants. """
+    def __init__(self):
+        super().__init__('midi')
+        for attr, value in _MIDI_CONSTANTS.items():
+            setattr(self, attr, value)
+        self._next_value = 1 << 20
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        value = self._next_value
+        self._next_value += 1
+        setattr(self, attr, value)
+        return value
+
+
+def _rgb_to_hsv_color(color):
+    return colorsys.rgb_to_hsv(((color >> 16) & 0xFF) / 255.0, ((color >> 8) & 0xFF) / 255.0, (color & 0xFF) / 255.0)
+
+
+def make_fl_modules(state, call_counts):
+    """ Returns the stand-ins of the FL Studio modules shared by both scripts, by module name.
+
+    :param state: FLState behind the stand-ins.
+    :param call_counts: mapping of 'module.function' -> number of calls, updated as the stand-ins are called.
+    """
+    def set_item(values, value_fn=lambda value: value):
+        def set_fn(index, value, *unused_args):
+            values[index] = value_fn(value)
+        return set_fn
+
+    def select_channel(index, value=1):
+        state.selected_channel = index
+
+    def set_song_pos(value, *unused_args):
+        state.song_pos = value
+
+    def set_loop_mode():
+        state.loop_mode = 1 - state.loop_mode
+
+    def record():
+        state.recording = not state.recording
+
+    def stop():
+        state.playing = False
+        state.song_pos = 0
+
+    def set_hint(message):
+        state.hint = message
+
+    def jump_to_pattern(index):
+        state.pattern_number = index
+
+    modules = {
+        'channels': {
+            'channelCount': lambda *args: len(state.channel_names),
+            'channelNumber': lambda *args: state.selected_channel,
+            'selectedChannel': lambda *args: state.selected_channel,
+            'selectChannel': select_channel,
+            'selectOneChannel': select_channel,
+            'getChannelName': lambda index, *args: state.channel_names[index],
+            'getChannelColor': lambda index, *args: state.channel_colors[index],
+            'setChannelColor': set_item(state.channel_colors),
+            'getChannelVolume': lambda index, *args: state.channel_volumes[index],
+            'setChannelVolume': set_item(state.channel_volumes),
+            'getChannelPan': lambda index, *args: state.channel_pans[index],
+            'setChannelPan': set_item(state.channel_pans),
+            'getChannelPitch': lambda index, *args: state.channel_pitches[index],
+            'setChannelPitch': set_item(state.channel_pitches),
+            'isChannelMuted': lambda index, *args: False,
+            'isChannelSolo': lambda index, *args: False,
+        },
+        'mixer': {
+            'trackCount': lambda: len(state.mixer_track_names),
+            'getTrackName': lambda index, *args: state.mixer_track_names[index],
+            'setTrackName': set_item(state.mixer_track_names),
+            'getTrackVolume': lambda index, *args: 0.8,
+            'getCurrentTempo': lambda *args: 120000,
+        },
+        'transport': {
+            'isPlaying': lambda: state.playing,
+            'isRecording': lambda: state.recording,
+            'getSongPos': lambda *args: state.song_pos,
+            'setSongPos': set_song_pos,
+            'getLoopMode': lambda: state.loop_mode,
+            'setLoopMode': set_loop_mode,
+            'record': record,
+            'stop': stop,
+        },
+        'ui': {
+            'getHintMsg': lambda: state.hint,
+            'setHintMsg': set_hint,
+            'getFocusedFormCaption': lambda: '',
+            'isMetronomeEnabled': lambda: True,
+            'isLoopRecEnabled': lambda: False,
+        },
+        'playlist': {
+            'trackCount': lambda: len(state.playlist_track_names),
+            'getTrackName': lambda index: state.playlist_track_names[index - 1],
+            'setTrackName': lambda index, name: state.playlist_track_names.__setitem__(index - 1, name),
+            'getVisTimeBar': lambda: 1 + state.song_pos // 384,
+            'getVisTimeStep': lambda: (state.song_pos // 24) % 16,
+            'getVisTimeTick': lambda: state.song_pos % 24,
+        },
+        'patterns': {
+            'patternCount': lambda: len(state.pattern_names),
+            'patternNumber': lambda: state.pattern_number,
+            'getPatternName': lambda index: state.pattern_names[(index - 1) % len(state.pattern_names)],
+            'setPatternName': lambda index, name: state.pattern_names.__setitem__(index - 1, name),
+            'jumpToPattern': jump_to_pattern,
+            'selectPattern': lambda index, *args: jump_to_pattern(index),
+        },
+        'general': {
+            'getVersion': lambda: 10,
+            'getRecPPQ': lambda: 96,
+            'getUndoHistoryLast': lambda: 0,
+        },
+        'arrangement': {},
+        'plugins': {
+            'isValid': lambda *args: False,
+            'getParamName': lambda *args: '',
+        },
+        'utils': {
+            'RGBToHSVColor': _rgb_to_hsv_color,
+            'HSVtoRGB': colorsys.hsv_to_rgb,
+            'ColorToRGB': lambda color: ((color >> 16) & 0xFF, (color >> 8) & 0xFF, color & 0xFF),
+            'RGBToColor': lambda r, g, b: (r << 16) | (g << 8) | b,
+        },
+    }
+    result = {name: StandInModule(name, functions, call_counts) for name, functions in modules.items()}
+    result['midi'] = _MidiConstants()
+    return result
+
+
+class StandInEvent:
+    """ Stand-in for the event FL Studio passes to OnMidiMsg. """
+    def __init__(self, status, data1, data2):
+        self.status = status
+        self.data1 = data1
+        self.data2 = data2
+        self.midiId = status & 0xF0
+        self.midiChan = status & 0x0F
+        self.controlNum = data1
+        self.controlVal = data2
+        self.note = data1
+        self.velocity = data2
+        self.pmeFlags = 0
+        self.handled = False
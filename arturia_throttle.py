@@ -0,0 +1,72 @@
+from arturia_scheduler import PRIORITY_NORMAL
+
+
+class Throttle:
+    """ Limits how often values are emitted, with leading and trailing edge semantics.
+
+    The first value submitted for a key after a quiet period is emitted immediately. Values submitted while the key is
+    still inside its interval are held back and only the latest one is emitted once the interval has passed, so a burst
+    of updates emits at most one value per interval and the last value of the burst always lands within one interval.
+    Keys are throttled independently of each other.
+    """
+    def __init__(self, scheduler, interval_ms, emit_fn, label=None, priority=PRIORITY_NORMAL):
+        """ Create a throttle.
+
+        :param scheduler: Scheduler used to emit held back values. Its clock is used for timing.
+        :param interval_ms: minimum number of milliseconds between two values emitted for the same key.
+        :param emit_fn: function called with (key, value) to emit a value. If it returns False, nothing was sent and
+            the call does not count against the interval.
+        :param label: name to group metrics for the trailing edge tasks under.
+        :param priority: scheduler lane for the trailing edge tasks. Avoid PRIORITY_BEST_EFFORT on schedulers that
+            drop best-effort tasks, as a dropped task holds the value back until the next submit for its key.
+        """
+        self._scheduler = scheduler
+        self._clock = scheduler.clock()
+        self._interval_ms = interval_ms
+        self._emit_fn = emit_fn
+        self._label = label
+        self._priority = priority
+        # Mapping of key -> timestamp in milliseconds of the last emitted value.
+        self._last_emit_ms = {}
+        # Mapping of key -> latest value held back for the trailing edge.
+        self._pending = {}
+        # Mapping of key -> ScheduledTask that emits the held back value.
+        self._flush_tasks = {}
+
+    def Submit(self, value, key=None):
+        """ Emit value now if key is outside its interval, otherwise hold it back until the interval has passed.
+
+        :param value: value to emit. Replaces any value held back for the same key.
+        :param key: independent throttling key.
+        :return: True if the value was emitted immediately.
+        """
+        time_ms = self._clock.time_ms()
+        last_ms = self._last_emit_ms.get(key)
+        if key not in self._pending and (last_ms is None or time_ms - last_ms >= self._interval_ms):
+            self._emit(key, value, time_ms)
+            return True
+        self._pending[key] = value
+        task = self._flush_tasks.get(key)
+        if task is None or not task.IsPending():
+            delay = 0 if last_ms is None else max(0, last_ms + self._interval_ms - time_ms)
+            self._flush_tasks[key] = self._scheduler.ScheduleTask(lambda: self._flush(key), delay=delay,
+                                                                  label=self._label, priority=self._priority)
+        return False
+
+    def Cancel(self, key=None):
+        """ Discard the value held back for key, if any. """
+        self._pending.pop(key, None)
+        self._scheduler.CancelTask(self._flush_tasks.pop(key, None))
+
+    def HasPending(self, key=None):
+        """ Returns True if a value is held back for key. """
+        return key in self._pending
+
+    def _flush(self, key):
+        self._flush_tasks.pop(key, None)
+        if key in self._pending:
+            self._emit(key, self._pending.pop(key), self._clock.time_ms())
+
+    def _emit(self, key, value, time_ms):
+        if self._emit_fn(key, value) is not False:
+            self._last_emit_ms[key] = time_ms
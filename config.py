@@ -22,6 +22,10 @@ PLUGIN_FORWARDING_MIDI_IN_PORT = 10
 # Set to True to put display text hints in all caps.
 HINT_DISPLAY_ALL_CAPS = False
 
+# Additional abbreviations used to fit display text hints on the 16 character display. Words are matched regardless of
+# case and the abbreviation follows the case of the word. For example: {'Harmonics': 'Harm', 'Distortion': 'Dist'}
+DISPLAY_ABBREVIATIONS = {}
+
 # Set to True to enable color bank lights. On Essential keyboards, the pad colors are set to the active channel color.
 ENABLE_COLORIZE_BANK_LIGHTS = True
 
@@ -71,3 +75,27 @@ ENABLE_LONG_PRESS_SUSTAIN_ON_PADS = False
 
 # If True, this will treat the pad LED layout the same as 88-key which is inverted.
 INVERT_LED_LAYOUT = False
+
+# Maximum number of microseconds spent running scheduled tasks (pad loop notes, light blinks, display scrolling) each
+# time FL Studio calls OnIdle. Tasks that do not fit are run on the next call. Set to 0 to run all due tasks at once.
+SCHEDULER_IDLE_BUDGET_US = 2000
+
+# If True, display updates where only one of the two lines changed send just that line to the keyboard, which roughly
+# halves the SysEx traffic while scrolling a single line. Disable if your keyboard firmware blanks the other line.
+DISPLAY_SEND_CHANGED_LINE_ONLY = False
+
+# Maximum average number of SysEx bytes per second sent to the keyboard for the display and lights. Sending too much
+# too quickly can get the keyboard into a state where it ignores updates until it is powered off. The MIDI link itself
+# carries at most 3125 bytes per second.
+MIDI_OUT_BYTES_PER_SECOND = 2500
+
+# Maximum number of SysEx bytes that may be sent back to back before the rate above applies.
+MIDI_OUT_BURST_BYTES = 512
+
+# Maximum average number of light updates per second sent to the keyboard. Light updates are queued and sent while FL
+# Studio is idle, and only the latest value of a light that changes again while queued is sent.
+LED_MESSAGES_PER_SECOND = 500
+
+# Maximum number of light updates that may be sent back to back before the rate above applies. The default lets a full
+# repaint of the 16 pads go out at once.
+LED_MESSAGE_BURST = 16
@@ -1,14 +1,94 @@
+from arturia_clock import SYSTEM_CLOCK
+
 # Enable to log messages out to console.
 DEBUG = False
 
-def log(tag, message, event=None):
-    """Log out messages to the script console if global DEBUG variable is True."""
+# Enable to record log messages into a ring buffer instead of formatting them as they happen. Dump the most recent ones
+# to the script output with the Actions.dump_trace macro.
+TRACE = False
+
+# Number of most recent log messages the trace ring buffer keeps.
+TRACE_BUFFER_SIZE = 512
+
+# Set to a path prefix, for example 'C:/Users/me/keylab', to record the callbacks FL Studio makes into the scripts to
+# <prefix>_daw.trace and <prefix>_midi.trace. The traces can be replayed offline with arturia_replay.py.
+CAPTURE_PATH_PREFIX = None
+
+# Enable to collect scheduler queue depth, lateness and execution time metrics. Dump them to the script output with
+# the Actions.dump_scheduler_metrics macro.
+SCHEDULER_METRICS = False
+
+# True if log does anything, derived from the settings above when the module is loaded. Hot paths check this before
+# calling log, so that logging costs a single attribute check when it is disabled.
+ENABLED = DEBUG or TRACE
+
+
+class TraceBuffer:
+    """ Fixed-size ring buffer of raw log records.
+
+    Records are (timestamp ms, tag, message, args, event fields) tuples. Messages are only formatted with their args
+    when the buffer is dumped, so recording costs a tuple and a list store.
+    """
+    def __init__(self, size):
+        self._records = [None] * size
+        # Index the next record is written at.
+        self._next = 0
+
+    def Record(self, tag, message, args, event):
+        fields = None
+        if event is not None:
+            fields = (event.midiId, event.status, event.controlNum, event.controlVal, event.data1, event.data2)
+        self._records[self._next] = (SYSTEM_CLOCK.time_ms(), tag, message, args, fields)
+        self._next = (self._next + 1) % len(self._records)
+
+    def Clear(self):
+        self._records = [None] * len(self._records)
+        self._next = 0
+
+    def Dump(self):
+        """ Print the records to the script output, oldest first. """
+        for record in self._records[self._next:] + self._records[:self._next]:
+            if record is not None:
+                timestamp_ms, tag, message, args, fields = record
+                print('%10.1f %s' % (timestamp_ms, _format(tag, message, args, fields)))
+
+
+_trace_buffer = TraceBuffer(TRACE_BUFFER_SIZE)
+
+
+def log(tag, message, *args, event=None):
+    """Log out messages to the script console if global DEBUG variable is True, and record them if TRACE is True.
+
+    :param tag: category of the message.
+    :param message: message, formatted with args using the % operator only if it gets printed.
+    :param event: optional MIDI event the message is about.
+    """
     if DEBUG:
-        event_str = _event_as_string(event) if event is not None else '_' * 63
-        print('%63s | [%s] %s' % (event_str, tag, message))
+        print(_format(tag, message, args, _event_fields(event)))
+    if TRACE:
+        _trace_buffer.Record(tag, message, args, event)
+
+
+def dump_trace():
+    """ Print the log messages recorded while TRACE is True to the script output. """
+    if not TRACE:
+        print('No trace recorded. Set debug.TRACE = True to record one.')
+    _trace_buffer.Dump()
+
+
+def _event_fields(event):
+    if event is None:
+        return None
+    return event.midiId, event.status, event.controlNum, event.controlVal, event.data1, event.data2
+
+
+def _format(tag, message, args, fields):
+    if args:
+        message = message % args
+    event_str = _event_as_string(fields) if fields is not None else '_' * 63
+    return '%63s | [%s] %s' % (event_str, tag, message)
 
 
-def _event_as_string(event):
-    """Convert a midi event packet to a string representation."""
-    return '[id, status, cnum, cval, d1, d2] = %3d, %3d, %3d, %3d, %3d, %3d' % (
-        event.midiId, event.status, event.controlNum, event.controlVal, event.data1, event.data2)
\ No newline at end of file
+def _event_as_string(fields):
+    """Convert the fields of a midi event packet to a string representation."""
+    return '[id, status, cnum, cval, d1, d2] = %3d, %3d, %3d, %3d, %3d, %3d' % fields
@@ -5,6 +5,7 @@ import version
 from arturia import ArturiaController
 from arturia_processor import ArturiaMidiProcessor
 
+import arturia_capture
 import arturia_midi
 import config
 import ui
@@ -16,7 +17,12 @@ WELCOME_DISPLAY_INTERVAL_MS = 1500
 
 _controller = ArturiaController()
 _processor = ArturiaMidiProcessor(_controller)
-_payload_buffer = []
+arturia_midi.set_output_arbiter(arturia_midi.MidiOutArbiter(
+    _controller.scheduler(), config.MIDI_OUT_BYTES_PER_SECOND, config.MIDI_OUT_BURST_BYTES))
+# Reassembles the light commands the MIDI script sends for the device.
+_payload_decoder = arturia_midi.InterScriptPayloadDecoder()
+# Records the callbacks below for offline replay, if enabled in debug.py.
+_capture = arturia_capture.open_capture('daw')
 
 # --------------------[ MIDI Script Integration Events for FL Studio ]---------------------------
 
@@ -35,30 +41,41 @@ def OnInit():
 
 def OnDeInit():
     print('Unloading plugin...')
+    if _capture is not None:
+        _capture.Close()
 
 def OnIdle():
+    if _capture is not None:
+        _capture.OnIdle()
     _controller.Idle()
 
 
 def OnMidiMsg(event):
-    global _payload_buffer, _processor
-    if event.status == arturia_midi.INTER_SCRIPT_STATUS_BYTE:
-        if event.data1 == arturia_midi.INTER_SCRIPT_DATA1_BEGIN_PAYLOAD_CMD:
-            _payload_buffer = []
-        elif event.data1 == arturia_midi.INTER_SCRIPT_DATA1_END_PAYLOAD_CMD:
-            arturia_midi.send_to_device(_payload_buffer)
-            _payload_buffer = []
-        elif event.data1 == arturia_midi.INTER_SCRIPT_DATA1_UPDATE_STATE:
+    global _processor
+    if _capture is not None:
+        _capture.OnMidiMsg(event)
+    if arturia_midi.is_packed_payload(event.status):
+        payloads = _payload_decoder.Feed(event.status, event.data1, event.data2)
+        if payloads is not None:
+            for payload in payloads:
+                arturia_midi.send_to_device(payload)
+                # Light commands from the other script change LEDs that this script keeps track of.
+                _controller.lights().NoteCommandSent(payload)
+        event.handled = True
+    elif event.status == arturia_midi.INTER_SCRIPT_STATUS_BYTE:
+        if event.data1 == arturia_midi.INTER_SCRIPT_DATA1_UPDATE_STATE:
             if event.data2 == arturia_midi.INTER_SCRIPT_DATA2_STATE_PAD_RECORD_START:
                 _processor.NotifyPadRecordingState(True)
             elif event.data2 == arturia_midi.INTER_SCRIPT_DATA2_STATE_PAD_RECORD_STOP:
                 _processor.NotifyPadRecordingState(False)
             elif event.data2 == arturia_midi.INTER_SCRIPT_DATA2_STATE_IDLE_AVAILABLE:
                 _controller.DisableInterscriptIdle()
-        event.handled = True
-    elif event.status == arturia_midi.PAYLOAD_STATUS_BYTE:
-        _payload_buffer.append(event.data1)
-        _payload_buffer.append(event.data2)
+            elif event.data2 == arturia_midi.INTER_SCRIPT_DATA2_STATE_DEVICE_MODE_CHANGED:
+                # Send all lights and the display again, over what the keyboard set for the other mode.
+                _controller.lights().Invalidate()
+                _controller.display().Invalidate()
+                _controller.Sync(0xFFFF)
+                _controller.RefreshDisplay()
         event.handled = True
     else:
         _processor.ProcessEvent(event)
@@ -66,8 +83,12 @@ def OnMidiMsg(event):
 
 
 def OnRefresh(flags):
+    if _capture is not None:
+        _capture.OnRefresh(flags)
     _controller.Sync(flags)
 
 
 def OnUpdateBeatIndicator(value):
+    if _capture is not None:
+        _capture.OnUpdateBeatIndicator(value)
     _controller.metronome().ProcessBeat(value)
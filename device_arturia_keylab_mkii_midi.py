@@ -3,14 +3,17 @@
 # receiveFrom=Arturia Keylab mkII DAW (MIDIIN2/MIDIOUT2)
 import channels
 import config
+import debug
 import device
 
+import arturia_capture
 import arturia_leds
 import arturia_midi
 import version
 
+from arturia_animation import LedAnimation, LedAnimator
 from arturia_leds import ArturiaLights
-from arturia_scheduler import Scheduler
+from arturia_scheduler import PRIORITY_BEST_EFFORT, Scheduler
 from arturia_recorder import Recorder
 from arturia_savedata import SaveData
 
@@ -29,18 +32,18 @@ REC_BUTTON_ID = 95
 STOP_BUTTON_ID = 93
 
 
-def dispatch_to_other_scripts(payload):
-    arturia_midi.dispatch_message_to_other_scripts(
-        arturia_midi.INTER_SCRIPT_STATUS_BYTE, 0, 0, payload=payload)
-
-
-_scheduler = Scheduler()
+# Only the record blink is best-effort here, so it is safe to drop a blink rather than delay notes when Idle is busy.
+_scheduler = Scheduler(idle_budget_us=config.SCHEDULER_IDLE_BUDGET_US, drop_best_effort=True)
 _savedata = SaveData()
 _recorder = Recorder(_scheduler, _savedata)
-_lights = ArturiaLights(send_fn=dispatch_to_other_scripts)
-
-_pad_recording_led = False
-_pad_recording_task = None
+# Light commands are sent to the DAW script, which owns the output to the device. The ones sent in one go are dispatched
+# together.
+_payload_batcher = arturia_midi.InterScriptPayloadBatcher()
+_lights = ArturiaLights(_scheduler, send_fn=_payload_batcher.Add, flush_fn=_payload_batcher.Flush)
+_animator = LedAnimator(_lights, _scheduler)
+
+# Name of the animation blinking the pad being recorded.
+RECORD_BLINK_ANIMATION = 'record blink'
 _sustain_enabled = False
 _buttons_held = set()
 _fallback_pad_values = {}
@@ -48,6 +51,8 @@ _longpress_status = {}
 # Drop notes that match the specified critiria
 _drop_note = None
 _interscript_idle_disabled = False
+# Records the callbacks for offline replay, if enabled in debug.py.
+_capture = arturia_capture.open_capture('midi')
 
 
 def OnInit():
@@ -55,21 +60,20 @@ def OnInit():
 
 
 def OnRefresh(flags):
+    if _capture is not None:
+        _capture.OnRefresh(flags)
     _savedata.Load()
 
 
 def OnShortPressDrumPad(event):
-    global _pad_recording_task
     note = event.data1
     velocity = event.data2
     if _recorder.IsRecording():
-        log('midi', 'Stop Recording. short press detected for %s' % str(note))
-        _recorder.StopRecording()
-        _scheduler.CancelTask(_pad_recording_task)
-        _pad_recording_task = None
+        log('midi', 'Stop Recording. short press detected for %s', note)
+        StopRecording()
     elif event.status == 153:
         global _sustain_enabled
-        log('midi', 'Play. short press detected for %s. Sustain=%s' % (str(note), _sustain_enabled))
+        log('midi', 'Play. short press detected for %s. Sustain=%s', note, _sustain_enabled)
         if not _recorder.Play(note, loop=_sustain_enabled):
             if config.ENABLE_MPC_STYLE_PADS:
                 index = note - 0x24
@@ -90,12 +94,12 @@ def OnShortPressDrumPad(event):
 
 
 def OnLongPressDrumPad(note):
-    global _pad_recording_led, _drop_note
+    global _drop_note
     if _recorder.IsRecording():
-        log('midi', 'Stop Recording. Long press detected for %s' % str(note))
-        _recorder.StopRecording()
+        log('midi', 'Stop Recording. Long press detected for %s', note)
+        StopRecording()
     else:
-        log('midi', 'Start Recording. Long press detected for %s' % str(note))
+        log('midi', 'Start Recording. Long press detected for %s', note)
         if config.ENABLE_MPC_STYLE_PADS:
             index = note - 0x24
             if index < channels.channelCount():
@@ -106,20 +110,18 @@ def OnLongPressDrumPad(note):
 
         _drop_note = note
         _recorder.StartRecording(note)
-        _pad_recording_led = False
-        BlinkLight(note)
+        blink = LedAnimation([ArturiaLights.getPadLedId(note)], [[ArturiaLights.LED_ON], [ArturiaLights.LED_OFF]])
+        _animator.Play(RECORD_BLINK_ANIMATION, blink, period_ms=500, priority=PRIORITY_BEST_EFFORT)
 
 
-def BlinkLight(note):
-    global _pad_recording_led, _pad_recording_task
-    if _recorder.IsRecording():
-        led_id = ArturiaLights.getPadLedId(note)
-        _pad_recording_led = not _pad_recording_led
-        _lights.SetLights({led_id: ArturiaLights.AsOnOffByte(_pad_recording_led)})
-        _pad_recording_task = _scheduler.ScheduleTask(lambda: BlinkLight(note), delay=500)
+def StopRecording():
+    _recorder.StopRecording()
+    _animator.Stop(RECORD_BLINK_ANIMATION)
 
 
 def OnIdle():
+    if _capture is not None:
+        _capture.OnIdle()
     processIdle(disable_interscript_idle=True)
 
 
@@ -138,6 +140,8 @@ def processIdle(disable_interscript_idle=False):
 
 def OnMidiMsg(event):
     global _drop_note, _buttons_held, _recorder
+    if _capture is not None:
+        _capture.OnMidiMsg(event)
     note = event.data1
     log_msg = True
     should_color_pads = ((not arturia_leds.ESSENTIAL_KEYBOARD and config.ENABLE_MK2_COLORIZE_PAD_LIGHTS) or
@@ -152,8 +156,9 @@ def OnMidiMsg(event):
             if (note not in _longpress_status
                     and REC_BUTTON_ID not in _buttons_held
                     and not config.ENABLE_LONG_PRESS_SUSTAIN_ON_PADS):
-                log('midi', 'Schedule long press detection for %s' % str(note))
-                _longpress_status[note] = _scheduler.ScheduleTask(lambda: OnLongPressDrumPad(note), delay=1000)
+                log('midi', 'Schedule long press detection for %s', note)
+                _longpress_status[note] = _scheduler.ScheduleTask(lambda: OnLongPressDrumPad(note), delay=1000,
+                                                                  label='long press')
             if REC_BUTTON_ID in _buttons_held:
                 OnLongPressDrumPad(note)
             else:
@@ -174,7 +179,7 @@ def OnMidiMsg(event):
 
                 if event.data1 in _longpress_status:
                     if _scheduler.CancelTask(_longpress_status[event.data1]):
-                        log('midi', 'Long press canceled for %s' % str(event.data1))
+                        log('midi', 'Long press canceled for %s', event.data1)
                     del _longpress_status[event.data1]
 
             if should_color_pads:
@@ -190,7 +195,7 @@ def OnMidiMsg(event):
             _buttons_held.add(event.data2)
             if event.data2 == STOP_BUTTON_ID:
                 if _recorder.IsRecording():
-                    _recorder.StopRecording()
+                    StopRecording()
                 else:
                     _recorder.StopPlaying()
         elif event.data1 == arturia_midi.INTER_SCRIPT_DATA1_BTN_UP_CMD and event.data2 in _buttons_held:
@@ -202,9 +207,18 @@ def OnMidiMsg(event):
         event.handled = True
     else:
         if 0xB0 <= event.status <= 0xBF:
-            if event.data1 == 118 and event.data2 == 127:
-                # User switched to Analog Lab mode.
-                log('analoglab', 'Switched to Analog Lab.')
+            if event.data1 == 118:
+                if event.data2 == 127:
+                    # User switched to Analog Lab mode.
+                    log('analoglab', 'Switched to Analog Lab.')
+                else:
+                    # User switched back to DAW mode. The keyboard drew its own LEDs and display in the other mode, so
+                    # what the scripts last sent is no longer shown.
+                    _lights.Invalidate()
+                    arturia_midi.dispatch_message_to_other_scripts(
+                        arturia_midi.INTER_SCRIPT_STATUS_BYTE,
+                        arturia_midi.INTER_SCRIPT_DATA1_UPDATE_STATE,
+                        arturia_midi.INTER_SCRIPT_DATA2_STATE_DEVICE_MODE_CHANGED)
             if event.data1 == 64:
                 global _sustain_enabled
                 _sustain_enabled = (event.data2 == 127)
@@ -215,9 +229,12 @@ def OnMidiMsg(event):
         message = event.status + (event.data1 << 8) + (event.data2 << 16) + (port_num << 24)
         device.forwardMIDICC(message, 2)
 
-    if log_msg:
-        log('midi', 'status: %d, data1: %d, data2: %d handled: %s' % (event.status, event.data1, event.data2, str(event.handled)))
+    if log_msg and debug.ENABLED:
+        log('midi', 'status: %d, data1: %d, data2: %d handled: %s', event.status, event.data1, event.data2,
+            event.handled)
 
 
 def OnDeInit():
     print('Unloading plugin...')
+    if _capture is not None:
+        _capture.Close()
@@ -13,7 +13,10 @@ import ui
 
 import time
 
+import arturia_midi
 import arturia_playlist
+import arturia_scheduler
+import debug
 
 SCRIPT_VERSION = general.getVersion()
 
@@ -174,6 +177,21 @@ class Actions:
         Actions._navigate_to_menu('view')
         Actions.fl_windows_shortcut('s')
 
+    @staticmethod
+    def dump_scheduler_metrics(unused_param_value):
+        """Dump sched stats"""
+        arturia_scheduler.DumpAllMetrics()
+
+    @staticmethod
+    def dump_sysex_counters(unused_param_value):
+        """Dump sysex stats"""
+        arturia_midi.DumpAllSysexCounters()
+
+    @staticmethod
+    def dump_trace(unused_param_value):
+        """Dump trace"""
+        debug.dump_trace()
+
     @staticmethod
     def clone_pattern(unused_param_value):
         """Clone pattern"""